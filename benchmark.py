@@ -0,0 +1,203 @@
+import argparse  # For command line options
+import json  # For the results file
+import os  # For paths and the environment of the pipeline stages
+import resource  # For the peak memory use
+import shutil  # For copying the pipeline into a scratch directory
+import subprocess  # For the current git commit
+import tempfile  # For the scratch directory
+import time  # For wall time and timestamps
+import pandas as pd
+import run_llama
+import pipeline
+from mock_ollama import start_mock_server
+
+# File the results are appended to, one JSON object per line
+RESULTS_FILE = 'benchmark_results.jsonl'
+
+# Files needed to run the whole pipeline in a scratch directory
+PIPELINE_FILES = ['separator.py', 'split_diagnosis.py', 'stem_data.py', 'text_normalizer.py', 'run_llama.py',
+                  'llm_cache.py', 'checkpoint.py', 'extract_results.py', 'medical_terms.json', 'print_final_statistics.py',
+                  'frame_io.py', 'metrics.py', 'pipeline.py']
+PIPELINE_DATA = ['cases.csv', 'cases_with_diagnosis.csv', 'cases_with_separated_diagnosis_truncated.csv',
+                 'cases_diagnosis_cleaned_relevant.csv']
+
+# Function to return the nearest-rank percentile of a sorted list
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, int(round(q / 100 * len(sorted_values))) - 1))
+    return sorted_values[rank]
+
+# Function to return the peak resident memory in MB of this process or of its finished children
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(who).ru_maxrss
+    return peak / 1024 / 1024 if os.uname().sysname == 'Darwin' else peak / 1024
+
+# Function to return the current git commit, None outside a git checkout
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Function to benchmark the query stage in-process: `rows` cases from input_file (repeated when
+# the file is shorter) are sent to the mock server with the given concurrency and batching.
+def benchmark_query(input_file, rows, concurrency, batch_tokens, work_dir):
+    texts = pd.read_csv(input_file, usecols=['pre_diagnosis'])['pre_diagnosis'].dropna().tolist()
+    # Every copy gets a suffix so the duplicate texts are not skipped
+    texts = [f"{texts[i % len(texts)]} (copy {i // len(texts)})" for i in range(rows)]
+    query_input = os.path.join(work_dir, 'query_input.csv')
+    query_output = os.path.join(work_dir, 'query_output.csv')
+    pd.DataFrame({'pre_diagnosis': texts}).to_csv(query_input, index=False)
+
+    # Time every request by wrapping the function sending the payloads
+    latencies = []
+    send_request = run_llama._send_llama_request
+
+    def timed_send_request(*args, **kwargs):
+        start_time = time.perf_counter()
+        try:
+            return send_request(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start_time)
+
+    run_llama._send_llama_request = timed_send_request
+    try:
+        start_time = time.perf_counter()
+        run_llama.generate_llm_diagnosis(query_input, query_output, concurrency=concurrency, echo=False,
+                                         batch_tokens=batch_tokens)
+        elapsed = time.perf_counter() - start_time
+    finally:
+        run_llama._send_llama_request = send_request
+
+    written = len(pd.read_csv(query_output))
+    latencies.sort()
+    return {
+        'rows': written,
+        'requests': len(latencies),
+        'seconds': elapsed,
+        'rows_per_second': written / elapsed if elapsed else None,
+        'latency_p50': percentile(latencies, 50),
+        'latency_p95': percentile(latencies, 95),
+        'latency_p99': percentile(latencies, 99),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+# Function to benchmark the whole pipeline in a scratch copy of this directory, forcing every stage to run
+def benchmark_pipeline(concurrency, batch_tokens, intermediate_format, work_dir):
+    source_dir = os.path.dirname(os.path.abspath(__file__))
+    for name in PIPELINE_FILES + PIPELINE_DATA:
+        if os.path.exists(os.path.join(source_dir, name)):
+            shutil.copy(os.path.join(source_dir, name), work_dir)
+
+    # The copied text_normalizer.py looks for nltk_data next to itself, point the stages to the one of this checkout
+    local_nltk_data = os.path.join(source_dir, 'nltk_data')
+    if os.path.isdir(local_nltk_data):
+        os.environ['NLTK_DATA'] = os.pathsep.join(filter(None, [local_nltk_data, os.environ.get('NLTK_DATA')]))
+
+    query_args = ['--quiet', '--no-cache', '--concurrency', str(concurrency), '--batch-tokens', str(batch_tokens)]
+    previous_dir = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        # The query stage runs as its own process and finds the mock server through OLLAMA_URL
+        start_time = time.perf_counter()
+        report = pipeline.run_pipeline(force=set(pipeline.STAGE_NAMES), stage_args={'query': query_args},
+                                       intermediate_format=intermediate_format)
+        elapsed = time.perf_counter() - start_time
+        rows = len(pd.read_csv('llama_answers.csv')) if os.path.exists('llama_answers.csv') else 0
+    finally:
+        os.chdir(previous_dir)
+
+    stage_seconds = {name: seconds for name, status, seconds in report if status == 'ran'}
+    return {
+        'rows': rows,
+        'seconds': elapsed,
+        'rows_per_second': rows / elapsed if elapsed else None,
+        'stage_seconds': stage_seconds,
+        'failed_stages': [name for name, status, _ in report if status == 'failed'],
+        'peak_rss_mb': peak_rss_mb(resource.RUSAGE_CHILDREN),
+    }
+
+# Function to load the earlier results of the same benchmark with the same parameters
+def previous_results(results_file, params):
+    if not os.path.exists(results_file):
+        return []
+    matches = []
+    with open(results_file, 'r', encoding='utf-8') as file:
+        for line in file:
+            if line.strip():
+                result = json.loads(line)
+                if result.get('params') == params:
+                    matches.append(result)
+    return matches
+
+# Function to print the metrics next to the last earlier result with the same parameters
+def print_comparison(metrics, previous):
+    baseline = previous[-1]['metrics'] if previous else {}
+    if previous:
+        print(f"\nCompared to commit {previous[-1].get('commit')} ({previous[-1].get('timestamp')}):")
+    # Per-stage times are compared like the other metrics
+    flat_metrics = {**metrics, **{f"stage_{name}": value for name, value in metrics.get('stage_seconds', {}).items()}}
+    flat_baseline = {**baseline, **{f"stage_{name}": value for name, value in baseline.get('stage_seconds', {}).items()}}
+    print(f"{'Metric':<16} {'Current':>12} {'Previous':>12} {'Change':>9}")
+    for name, value in flat_metrics.items():
+        if not isinstance(value, (int, float)):
+            continue
+        old = flat_baseline.get(name)
+        change = f"{(value - old) / old * 100:+8.1f}%" if isinstance(old, (int, float)) and old else ''
+        old_text = f"{old:12.4f}" if isinstance(old, (int, float)) else f"{'-':>12}"
+        print(f"{name:<16} {value:12.4f} {old_text} {change:>9}")
+
+# Command line entry point of the script
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the query stage or the whole pipeline "
+                                                 "against a local mock Ollama server.")
+    parser.add_argument("mode", choices=['query', 'pipeline'], help="What to benchmark")
+    parser.add_argument("--input", default="cases_diagnosis_cleaned_relevant.csv",
+                        help="CSV with the pre_diagnosis column used by the query benchmark")
+    parser.add_argument("--rows", type=int, default=500, help="Number of rows sent by the query benchmark")
+    parser.add_argument("--concurrency", type=int, default=8, help="Number of requests kept in flight")
+    parser.add_argument("--batch-tokens", type=int, default=0, help="Batch budget passed to run_llama")
+    parser.add_argument("--format", choices=list(pipeline.INTERMEDIATE_EXTENSIONS), default='csv',
+                        help="Intermediate format of the pipeline benchmark")
+    parser.add_argument("--latency", type=float, default=0.05, help="Mock server seconds before the first token")
+    parser.add_argument("--jitter", type=float, default=0.01, help="Mock server latency jitter (seconds)")
+    parser.add_argument("--token-rate", type=float, default=500.0,
+                        help="Mock server tokens per second, 0 streams without delay")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Mock server share of HTTP 500 answers")
+    parser.add_argument("--results", default=RESULTS_FILE, help="JSON lines file the results are appended to")
+    parser.add_argument("--no-save", action="store_true", help="Only print the results")
+    args = parser.parse_args(argv)
+
+    server = start_mock_server(latency=args.latency, jitter=args.jitter, token_rate=args.token_rate,
+                               error_rate=args.error_rate)
+    run_llama.OLLAMA_URL = os.environ['OLLAMA_URL'] = f"http://127.0.0.1:{server.server_port}"
+
+    params = {
+        'mode': args.mode, 'concurrency': args.concurrency, 'batch_tokens': args.batch_tokens,
+        'latency': args.latency, 'jitter': args.jitter, 'token_rate': args.token_rate, 'error_rate': args.error_rate,
+    }
+    if args.mode == 'query':
+        params['rows'] = args.rows
+    else:
+        params['format'] = args.format
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        if args.mode == 'query':
+            metrics = benchmark_query(args.input, args.rows, args.concurrency, args.batch_tokens, work_dir)
+        else:
+            metrics = benchmark_pipeline(args.concurrency, args.batch_tokens, args.format, work_dir)
+    server.shutdown()
+
+    print_comparison(metrics, previous_results(args.results, params))
+    if not args.no_save:
+        result = {'commit': git_commit(), 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                  'params': params, 'metrics': metrics}
+        with open(args.results, 'a', encoding='utf-8') as file:
+            file.write(json.dumps(result) + '\n')
+        print(f"\nResults appended to {args.results}")
+
+if __name__ == '__main__':
+    main()
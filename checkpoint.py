@@ -0,0 +1,180 @@
+import csv  # For importing and finalizing the output CSV
+import hashlib  # For hashing the case texts into row keys
+import json  # For the journal lines
+import os  # For fsync and atomic renames
+import time  # For the sync interval
+import numpy as np
+
+# Layout of an index entry: the row key and the journal offset just after its line
+INDEX_DTYPE = np.dtype([('key', '<u8'), ('end', '<u8')])
+
+
+# Function to build the 64-bit key of a row from its pre_diagnosis text
+def make_row_key(text):
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little')
+
+# Function to build the keys of many texts at once as a uint64 array, non-string values get the key 0
+def make_row_keys(texts):
+    digests = b''.join(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest() if isinstance(text, str)
+                       else bytes(8) for text in texts)
+    return np.frombuffer(digests, dtype='<u8').astype(np.uint64)
+
+
+class CheckpointJournal:
+    """
+    Append-only journal of the processed rows, one JSON line per row, with a binary
+    index next to it (`<path>.idx`) holding the key and end offset of every line.
+
+    Opening the journal only loads the index (16 bytes per row) and scans the lines
+    written after the last indexed one, so resuming does not depend on the size of the
+    texts. A partially written last line is cut off. Lines are written in batches and
+    made durable with fsync every `sync_every` rows or `sync_interval` seconds; the
+    index is only extended after the journal lines it points to are on disk.
+    """
+
+    def __init__(self, path, sync_every=100, sync_interval=5.0):
+        self.path = path
+        self.index_path = path + '.idx'
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.recovered_rows = 0
+        self.truncated_bytes = 0
+        self._unsynced = []
+        self._last_sync = time.monotonic()
+
+        index = self._load_index()
+        self._file = open(self.path, 'a+b')
+        self._file.seek(0, os.SEEK_END)
+        journal_size = self._file.tell()
+        # Entries pointing past the end of the journal cannot be trusted
+        index = index[index['end'] <= journal_size]
+        tail_start = int(index['end'][-1]) if len(index) else 0
+        recovered = self._recover_tail(tail_start, journal_size)
+        if recovered:
+            self._append_index(recovered)
+            index = np.concatenate([index, np.array(recovered, dtype=INDEX_DTYPE)])
+        self.recovered_rows = len(recovered)
+        self._offset = self._file.tell()
+        self._keys = np.sort(index['key'])
+        self.rows = len(index)
+
+    # Function to load the index, dropping an incomplete last entry
+    def _load_index(self):
+        if not os.path.exists(self.index_path):
+            return np.empty(0, dtype=INDEX_DTYPE)
+        complete_size = os.path.getsize(self.index_path) // INDEX_DTYPE.itemsize * INDEX_DTYPE.itemsize
+        if complete_size != os.path.getsize(self.index_path):
+            os.truncate(self.index_path, complete_size)
+        return np.fromfile(self.index_path, dtype=INDEX_DTYPE)
+
+    # Function to index the complete lines written after the last index entry and to cut off
+    # a partially written or corrupted last line, returns the recovered (key, end) entries
+    def _recover_tail(self, tail_start, journal_size):
+        recovered = []
+        valid_end = tail_start
+        self._file.seek(tail_start)
+        for line in self._file:
+            if not line.endswith(b'\n'):
+                break
+            try:
+                key = int(json.loads(line)['key'], 16)
+            except (ValueError, KeyError, TypeError):
+                break
+            valid_end += len(line)
+            recovered.append((key, valid_end))
+        if valid_end < journal_size:
+            self.truncated_bytes = journal_size - valid_end
+            self._file.truncate(valid_end)
+            os.fsync(self._file.fileno())
+        self._file.seek(valid_end)
+        return recovered
+
+    def _append_index(self, entries):
+        with open(self.index_path, 'ab') as index_file:
+            index_file.write(np.array(entries, dtype=INDEX_DTYPE).tobytes())
+            index_file.flush()
+            os.fsync(index_file.fileno())
+
+    # Function to tell, for an array of row keys, which ones were already journaled when it was opened
+    def contains(self, keys):
+        keys = np.asarray(keys, dtype=np.uint64)
+        if not len(self._keys):
+            return np.zeros(len(keys), dtype=bool)
+        # Looking up the keys in sorted order keeps the binary searches cache friendly
+        order = np.argsort(keys)
+        sorted_keys = keys[order]
+        positions = np.minimum(np.searchsorted(self._keys, sorted_keys), len(self._keys) - 1)
+        found = np.empty(len(keys), dtype=bool)
+        found[order] = self._keys[positions] == sorted_keys
+        return found
+
+    # Function to add a processed row, syncing when the batch is full or the interval has passed
+    def append(self, key, pre_diagnosis, llama_suggestions):
+        line = json.dumps({'key': f'{key:016x}', 'pre_diagnosis': pre_diagnosis,
+                           'llama_suggestions': llama_suggestions}, ensure_ascii=False) + '\n'
+        data = line.encode('utf-8')
+        self._file.write(data)
+        self._offset += len(data)
+        self._unsynced.append((key, self._offset))
+        self.rows += 1
+        if len(self._unsynced) >= self.sync_every or time.monotonic() - self._last_sync >= self.sync_interval:
+            self.sync()
+
+    # Function to make the appended rows durable, the journal first and then its index
+    def sync(self):
+        self._last_sync = time.monotonic()
+        if not self._unsynced:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._append_index(self._unsynced)
+        self._unsynced = []
+
+    # Function to import the rows of an existing output CSV (e.g. written before journaling was
+    # added), stopping at a truncated last row. Returns the number of imported rows.
+    def import_csv(self, csv_path):
+        imported = 0
+        with open(csv_path, mode='r', encoding='utf-8', newline='') as file:
+            reader = csv.DictReader(file, strict=True)
+            try:
+                for row in reader:
+                    if row.get('pre_diagnosis') and row.get('llama_suggestions') is not None:
+                        self.append(make_row_key(row['pre_diagnosis']), row['pre_diagnosis'], row['llama_suggestions'])
+                        imported += 1
+            except csv.Error as e:
+                print(f"Stopped importing {csv_path} at a malformed row: {e}")
+        self.sync()
+        return imported
+
+    # Function to write all the journaled rows to the output CSV atomically: a temporary file is
+    # written and synced next to it and then renamed over the output
+    def finalize(self, csv_path):
+        self.sync()
+        temporary_path = csv_path + '.tmp'
+        rows = 0
+        with open(self.path, 'rb') as journal_file, \
+                open(temporary_path, mode='w', newline='', encoding='utf-8') as output_file:
+            writer = csv.DictWriter(output_file, fieldnames=["pre_diagnosis", "llama_suggestions"],
+                                    quoting=csv.QUOTE_ALL)
+            writer.writeheader()
+            for line in journal_file:
+                row = json.loads(line)
+                writer.writerow({"pre_diagnosis": row['pre_diagnosis'], "llama_suggestions": row['llama_suggestions']})
+                rows += 1
+            output_file.flush()
+            os.fsync(output_file.fileno())
+        os.replace(temporary_path, csv_path)
+        return rows
+
+    def close(self):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+    # Function to delete the journal and its index, to start over
+    @staticmethod
+    def remove(path):
+        for file_path in (path, path + '.idx'):
+            if os.path.exists(file_path):
+                os.remove(file_path)
@@ -1,30 +1,44 @@
-def add_newline_after_comma(data):
-    result = []
-    inside_quotes = False
+import argparse  # For command line options
 
-    for char in data:
-        if char == '"':
-            inside_quotes = not inside_quotes
-        if char == ',' and not inside_quotes:
-            result.append('~')
-        else:
-            result.append(char)
+# Number of characters read and rewritten at a time
+BLOCK_SIZE = 8 * 1024 * 1024
 
-    return ''.join(result)
+# Function to replace the commas outside of quotes in a block of text with '~'.
+# `inside_quotes` is the quote state at the start of the block, the state at its end is returned
+# with the result so that the next block continues where this one stopped.
+def replace_unquoted_commas(block, inside_quotes=False):
+    # Splitting on the quotes gives the parts between them, which alternate between outside and inside
+    parts = block.split('"')
+    first_outside = 1 if inside_quotes else 0
+    for i in range(first_outside, len(parts), 2):
+        parts[i] = parts[i].replace(',', '~')
+    # Every quote toggles the state, so an odd number of quotes flips it
+    return '"'.join(parts), inside_quotes != (len(parts) % 2 == 0)
 
-# Define file paths
-input_file = 'cases.csv'
-output_file = 'cases_modified.csv'
+def add_newline_after_comma(data):
+    return replace_unquoted_commas(data)[0]
+
+# Function to rewrite a file block by block, so memory stays flat regardless of the size of the input
+def rewrite_file(input_file, output_file, block_size=BLOCK_SIZE, encoding='utf-8'):
+    inside_quotes = False
+    with open(input_file, 'r', encoding=encoding) as source, open(output_file, 'w', encoding=encoding) as destination:
+        for block in iter(lambda: source.read(block_size), ''):
+            output_block, inside_quotes = replace_unquoted_commas(block, inside_quotes)
+            destination.write(output_block)
 
-# Read the input file
-with open(input_file, 'r') as file:
-    input_data = file.read()
+# Command line entry point of the script
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replace the commas outside of quoted fields with '~'.")
+    parser.add_argument("--input", default="cases.csv", help="File to rewrite")
+    parser.add_argument("--output", default="cases_modified.csv", help="File that will contain the rewritten data")
+    parser.add_argument("--block-size", type=int, default=BLOCK_SIZE,
+                        help="Number of characters read and rewritten at a time")
+    parser.add_argument("--encoding", default="utf-8", help="Encoding of the input and output files")
+    args = parser.parse_args(argv)
 
-# Process the data
-output_data = add_newline_after_comma(input_data)
+    rewrite_file(args.input, args.output, block_size=args.block_size, encoding=args.encoding)
 
-# Write the output file
-with open(output_file, 'w') as file:
-    file.write(output_data)
+    print(f"Processed data saved to {args.output}")
 
-print(f"Processed data saved to {output_file}")
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -1,134 +1,336 @@
+import numpy as np
 import pandas as pd
 import re
-import nltk
-from nltk.corpus import stopwords
-from nltk.stem import PorterStemmer
-
-# Download necessary NLTK resources
-nltk.download('punkt')
-nltk.download('stopwords')
-
-# Initialize the Porter Stemmer and the stop words for filtering
-ps = PorterStemmer()
-stop_words = set(stopwords.words('english'))
-
-# Define a dictionary for common medical abbreviations and synonyms
-medical_terms_dict = {
-    'leprosy': ['lep', 'hansen'],
-    'multiple osteochondromas': ['mo', 'hme', 'hereditary multiple exostoses'],
-    'osteoarthritis': ['oa', 'degenerative joint disease'],
-    'juvenile idiopathic arthritis': ['jia', 'juvenile rheumatoid arthritis', 'jra'],
-    'sarcoma': ['sarcom', 'soft tissue tumor'],
-    'chronic osteomyelitis': ['co'],
-    'multibacillary leprosy': ['mb leprosy', 'mb lep', 'multibacillary lep'],
-    'pauci-bacillary leprosy': ['pb leprosy', 'pb lep', 'paucibacillary lep'],
-    'tuberculosis': ['tb', 'consumption'],
-    'rheumatoid arthritis': ['ra'],
-    'systemic lupus erythematosus': ['sle', 'lupus'],
-    'ankylosing spondylitis': ['as'],
-    'psoriatic arthritis': ['psa'],
-    'reactive arthritis': ['reiter syndrome'],
-    'sarcoidosis': ['sarcoid'],
-    'systemic sclerosis': ['scleroderma'],
-    'spondyloarthritis': ['spa'],
-    'systemic vasculitis': ['vasculitis']
-}
+import os
+import json
+import argparse  # For command line options
+from functools import lru_cache  # For loading the abbreviations only once
+from text_normalizer import TextNormalizer
+from frame_io import read_frame  # For CSV, Parquet or Arrow input
+from metrics import metrics, add_instrumentation_arguments, instrument_stage  # For timers and counters
+
+# Pattern matching the whitespace or hyphens between the words of a multi-word abbreviation
+PHRASE_GAP_PATTERN = re.compile(r"[\s-]+")
+
+# Function to load the dictionary of medical abbreviations and synonyms ({full term: [abbreviations]})
+def load_medical_terms(path):
+    with open(path, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+# Function to build a regex alternation from a character trie of the given words, so that the
+# regex engine branches on one character at a time instead of trying every word at every position
+def _trie_regex(words):
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}  # Marks the end of a word
+
+    def render(node):
+        branches = []
+        for char in sorted(key for key in node if key):
+            char_pattern = PHRASE_GAP_PATTERN.pattern if char == ' ' else re.escape(char)
+            branches.append(char_pattern + render(node[char]))
+        if not branches:
+            return ''
+        pattern = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        # A word that is also the prefix of a longer one makes the rest optional
+        return '(?:' + pattern + ')?' if '' in node else pattern
+
+    return render(trie)
+
+class AbbreviationExpander:
+    """
+    Expands medical abbreviations and synonyms in a single pass over the text.
+
+    The abbreviations are compiled once into one word-boundary regex, so only whole
+    words are replaced ('as' or 'co' inside ordinary words are left alone) and the
+    cost does not grow linearly with the size of the dictionary.
+    """
+
+    def __init__(self, terms_dict):
+        self.full_terms = {}
+        for full_term, abbreviations in terms_dict.items():
+            for abbreviation in abbreviations:
+                # Keys are normalized like the matches in _replace, so 'x-ray' and 'x ray' are the same entry
+                abbreviation = PHRASE_GAP_PATTERN.sub(' ', abbreviation.lower()).strip()
+                # The first full term listed for an abbreviation wins
+                if abbreviation and abbreviation not in self.full_terms:
+                    self.full_terms[abbreviation] = full_term
+        self.pattern = re.compile(r'\b' + _trie_regex(self.full_terms) + r'\b') if self.full_terms else None
+
+    def _replace(self, match):
+        return self.full_terms[PHRASE_GAP_PATTERN.sub(' ', match.group())]
+
+    def expand(self, text):
+        if self.pattern is None:
+            return text
+        return self.pattern.sub(self._replace, text)
+
+# Dictionary of common medical abbreviations and synonyms
+MEDICAL_TERMS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'medical_terms.json')
+
+# Function to load and compile the dictionary once, the first time an abbreviation is expanded
+@lru_cache(maxsize=None)
+def get_abbreviation_expander():
+    return AbbreviationExpander(load_medical_terms(MEDICAL_TERMS_FILE))
 
 # Function to replace known medical abbreviations and synonyms with their full form
 def expand_medical_abbreviations(text):
-    for full_term, abbreviations in medical_terms_dict.items():
-        for abbreviation in abbreviations:
-            if abbreviation in text:
-                text = text.replace(abbreviation, full_term)
-    return text
+    return get_abbreviation_expander().expand(text)
+
+# Shared normalizer expanding medical abbreviations before cleaning, tokenizing and stemming
+normalizer = TextNormalizer(preprocess=expand_medical_abbreviations)
 
 # Function to clean, separate words, and stem the diagnosis data
 def extract_relevant_terms(text):
-    # Convert text to lowercase for uniformity
-    text = text.lower()
+    return set(normalizer.terms(text))
 
-    # Expand any medical abbreviations or synonyms
-    text = expand_medical_abbreviations(text)
+# Number of suggestions scored per answer
+MAX_SUGGESTIONS = 5
 
-    # Remove any non-alphabetic characters
-    text = re.sub(r'[^a-z\s]', '', text)
+# Pattern matching the marker in front of a list item, either a number ("1." "2)" "3:") or a bullet
+# ("*" "•" or "-"). Numbers, "*" and "•" are recognized after any whitespace, as older answers were
+# stored on one line. A dash is only a bullet at the start of a line, since diagnoses often contain
+# dashes between spaces ("Lymphoma - B cell").
+# The groups keep the whole marker and its number, so re.split() returns
+# [preamble, marker, number, item, marker, number, item, ...].
+SUGGESTION_MARKER_PATTERN = re.compile(r'(?<!\S)((?:(\d{1,2})[.):]|[*\u2022]|^[ \t]*-)\s+)', re.MULTILINE)
 
-    # Tokenize the words
-    words = nltk.word_tokenize(text)
+# Characters stripped from both ends of a parsed suggestion
+SUGGESTION_STRIP_CHARS = ' \t\r\n.,;"\''
 
-    # Remove stopwords
-    relevant_words = [word for word in words if word not in stop_words]
+# Function to clean the parsed items, dropping empty ones
+def _clean_suggestions(items):
+    cleaned = (' '.join(item.split()).strip(SUGGESTION_STRIP_CHARS) for item in items if isinstance(item, str))
+    return [item for item in cleaned if item]
 
-    # Stem relevant words
-    stemmed_words = [ps.stem(word) for word in relevant_words]
+# Function to find the list of suggestions in a JSON answer: a list of strings, or the first list of
+# strings (or all string values) of an object such as {"diagnoses": [...]} or {"case_1": [...]}
+def _json_suggestions(text):
+    try:
+        answer = json.loads(text)
+    except json.JSONDecodeError:
+        return None
+    if isinstance(answer, list):
+        return answer
+    if isinstance(answer, dict):
+        for value in answer.values():
+            if isinstance(value, list):
+                return value
+        return list(answer.values())
+    return None
 
-    return set(stemmed_words)
+# Function to parse the suggestions of an answer in a single pass over its list markers.
+# Numbered, bulleted and JSON replies are supported. An answer with a "1." marker is read as a
+# numbered list, even when bullets come first, and only splits on the next expected number, so
+# numbers and bullets inside diagnoses ("type 2 diabetes") stay part of the item. Markers before
+# the first item of the list belong to the preamble and are dropped.
+# Returns the list of at most max_items suggestions (possibly fewer) and the detected format,
+# 'numbered', 'bulleted', 'json' or 'failed' when no suggestion was found.
+def parse_suggestions(text, max_items=MAX_SUGGESTIONS):
+    if not isinstance(text, str):
+        return [], 'failed'
+    stripped = text.strip()
+    if stripped[:1] in ('[', '{'):
+        items = _json_suggestions(stripped)
+        if items is not None:
+            items = _clean_suggestions(items)
+            return (items[:max_items], 'json') if items else ([], 'failed')
 
-# Function to extract the 5 diagnoses (from llama_suggestions)
-def extract_diagnoses_from_llamasuggestions(suggestions_text):
-    try:
-        # Use regex to extract the five diagnosis options (numbered 1-5)
-        diagnosis_list = re.findall(r'\d+\.\s([^\d]+)', suggestions_text)
-        if len(diagnosis_list) == 5:
-            return diagnosis_list
+    parts = SUGGESTION_MARKER_PATTERN.split(text)
+    markers = [(parts[i], parts[i + 1], parts[i + 2]) for i in range(1, len(parts), 3)]
+    # The first number of a list must be 1, bullets are only used when there is no numbered list
+    has_numbered_list = any(number is not None and int(number) == 1 for _, number, _ in markers)
+    list_format = 'numbered' if has_numbered_list else 'bulleted'
+    items = []
+    expected_number = 1
+    for marker, number, following in markers:
+        if list_format == 'numbered':
+            is_next_item = number is not None and int(number) == expected_number
         else:
-            return None  # Return None if there aren't exactly 5 diagnoses
-    except Exception as e:
-        print(f"Error extracting diagnoses: {e}")
-        return None
+            is_next_item = number is None
+        if is_next_item:
+            items.append(following)
+            expected_number += 1
+        elif items:
+            # Not the next marker of the list, the marker belongs to the current item
+            items[-1] += marker + following
+
+    items = _clean_suggestions(items)
+    if not items:
+        return [], 'failed'
+    return items[:max_items], list_format
+
+# Function to extract the diagnoses (from llama_suggestions), None when no diagnosis was found.
+# Lists with fewer than 5 diagnoses are kept.
+def extract_diagnoses_from_llamasuggestions(suggestions_text):
+    diagnosis_list, _ = parse_suggestions(suggestions_text)
+    return diagnosis_list or None
+
+class TermVocabulary:
+    """
+    Global vocabulary of stemmed terms, mapping every term to a column index so that
+    sets of terms can be stored as rows of a sparse binary matrix.
+    """
+
+    def __init__(self):
+        self.index = {}
+
+    def add(self, term_rows):
+        for terms in pd.unique(term_rows):
+            for term in terms:
+                if term not in self.index:
+                    self.index[term] = len(self.index)
+
+    # Function to encode a Series of term tuples as a binary CSR matrix with one row per tuple,
+    # every distinct term of a row is a 1 in its column. Repeated tuples are only encoded once.
+    def encode(self, term_rows):
+        # scipy is slow to import and only needed for scoring
+        from scipy import sparse
+        codes, unique_rows = pd.factorize(term_rows)
+        indptr = [0]
+        indices = []
+        for terms in unique_rows:
+            indices.extend({self.index[term] for term in terms})
+            indptr.append(len(indices))
+        data = np.ones(len(indices), dtype=np.float64)
+        unique_matrix = sparse.csr_matrix((data, indices, indptr), shape=(len(unique_rows), len(self.index)))
+        return unique_matrix[codes]
+
+# Function to compute the number of shared terms of every suggestion row and the diagnosis row of its
+# case, in one sparse operation. `case_rows` gives the diagnosis row of every suggestion row.
+def overlap_counts(suggestion_matrix, diagnosis_matrix, case_rows):
+    return np.asarray(suggestion_matrix.multiply(diagnosis_matrix[case_rows]).sum(axis=1)).ravel()
+
+# Function to compute the Jaccard index |S & D| / |S | D| of every suggestion and its diagnosis
+def jaccard_scores(suggestion_matrix, diagnosis_matrix, case_rows):
+    overlap = overlap_counts(suggestion_matrix, diagnosis_matrix, case_rows)
+    union = suggestion_matrix.getnnz(axis=1) + diagnosis_matrix.getnnz(axis=1)[case_rows] - overlap
+    return np.divide(overlap, union, out=np.zeros_like(overlap), where=union > 0)
+
+# Function to compute the inverse document frequency of every vocabulary term over the rows of the matrices
+def idf_weights(*matrices):
+    documents = sum(matrix.shape[0] for matrix in matrices)
+    document_frequency = sum(matrix.getnnz(axis=0) for matrix in matrices)
+    return np.log((1 + documents) / (1 + document_frequency)) + 1
+
+# Function to compute the share of the diagnosis term weight covered by every suggestion,
+# sum of the weights of the shared terms / sum of the weights of the diagnosis terms
+def weighted_overlap_scores(suggestion_matrix, diagnosis_matrix, case_rows, weights):
+    weighted_diagnoses = diagnosis_matrix.multiply(weights.reshape(1, -1)).tocsr()
+    shared = overlap_counts(suggestion_matrix, weighted_diagnoses, case_rows)
+    total = np.asarray(weighted_diagnoses.sum(axis=1)).ravel()[case_rows]
+    return np.divide(shared, total, out=np.zeros_like(shared), where=total > 0)
+
+# Function to print and record how the answers were parsed, so that no row is lost silently
+def report_parse_statistics(suggestion_formats, suggestion_counts):
+    format_counts = suggestion_formats.value_counts()
+    for list_format, count in format_counts.items():
+        metrics.inc(f'suggestions_{list_format}', int(count))
+    partial_mask = (suggestion_formats != 'failed') & (suggestion_counts < MAX_SUGGESTIONS)
+    metrics.inc('suggestions_partial', int(partial_mask.sum()))
+    print(f"Parsed answers: {', '.join(f'{count} {list_format}' for list_format, count in format_counts.items())}; "
+          f"{int(partial_mask.sum())} with fewer than {MAX_SUGGESTIONS} suggestions")
+    failed_rows = suggestion_formats.index[suggestion_formats == 'failed']
+    if len(failed_rows):
+        print(f"Warning: {len(failed_rows)} answers contain no suggestions and are skipped (answer rows: "
+              f"{', '.join(str(idx) for idx in failed_rows[:20])}{', ...' if len(failed_rows) > 20 else ''})")
+
+# Graded metrics that can be added to the binary match columns
+GRADED_METRICS = ['jaccard', 'weighted']
+
+# Function to score every answer of the LLM against the diagnosis of its case.
+# The cases file can be CSV, Parquet or Arrow, depending on its extension.
+# The suggestions and diagnoses are encoded once as sparse term matrices over a shared vocabulary,
+# the binary match_k columns and any of the GRADED_METRICS (jaccard_k, weighted_k) are computed from them.
+def score_answers(answers_file, cases_file, output_csv_file, graded_metrics=()):
+    # Load the datasets, only the case columns needed for the join and the scoring are read
+    answers_df = pd.read_csv(answers_file)
+    cases_df = read_frame(cases_file, columns=['pre_diagnosis', 'case_id', 'diagnosis'])
+
+    # Join every answer with its case once up front using matching 'pre_diagnosis'
+    # (the first case wins when several cases share the same text)
+    with metrics.timer('join_seconds'):
+        case_lookup = cases_df.drop_duplicates(subset='pre_diagnosis')[['pre_diagnosis', 'case_id', 'diagnosis']]
+        joined_df = answers_df.merge(case_lookup, on='pre_diagnosis', how='left', indicator=True)
+
+    # Report the answers that could not be matched with a case instead of dropping them silently
+    unmatched_df = joined_df[joined_df['_merge'] == 'left_only']
+    if not unmatched_df.empty:
+        print(f"Warning: {len(unmatched_df)} answers have no matching case and are skipped (answer rows: "
+              f"{', '.join(str(idx) for idx in unmatched_df.index[:20])}{', ...' if len(unmatched_df) > 20 else ''})")
+    joined_df = joined_df[joined_df['_merge'] == 'both']
+    metrics.inc('rows_unmatched', len(unmatched_df))
+
+    # Parse the suggestions of every answer, answers with fewer than 5 suggestions are kept and
+    # scored as not matching on the missing ranks
+    parsed = joined_df['llama_suggestions'].map(parse_suggestions)
+    suggestion_formats = parsed.str[1]
+    suggestion_counts = parsed.str[0].str.len()
+    report_parse_statistics(suggestion_formats, suggestion_counts)
+    parsed_mask = (suggestion_formats != 'failed').to_numpy()
+    scored_df = joined_df[parsed_mask]
+    suggestions = parsed[parsed_mask].str[0].map(lambda items: items + [''] * (MAX_SUGGESTIONS - len(items)))
+
+    # Normalize all case diagnoses and suggestions in one batch each, every distinct text only once
+    with metrics.timer('normalize_seconds'):
+        diagnosis_terms = normalizer.normalize_series(scored_df['diagnosis'])
+        suggestion_terms = normalizer.normalize_series(suggestions.explode())
+
+    # Encode both sides over the shared vocabulary, suggestion row 5 * i + k belongs to case row i
+    # (the padding of partial lists normalizes to no terms and never matches)
+    with metrics.timer('score_seconds'):
+        vocabulary = TermVocabulary()
+        vocabulary.add(diagnosis_terms)
+        vocabulary.add(suggestion_terms)
+        diagnosis_matrix = vocabulary.encode(diagnosis_terms)
+        suggestion_matrix = vocabulary.encode(suggestion_terms)
+        case_rows = np.repeat(np.arange(len(scored_df)), MAX_SUGGESTIONS)
+
+        # A suggestion matches when it shares at least one term with the actual diagnosis
+        scores = {'match': (overlap_counts(suggestion_matrix, diagnosis_matrix, case_rows) > 0).astype(int)}
+        if 'jaccard' in graded_metrics:
+            scores['jaccard'] = jaccard_scores(suggestion_matrix, diagnosis_matrix, case_rows)
+        if 'weighted' in graded_metrics:
+            weights = idf_weights(diagnosis_matrix, suggestion_matrix)
+            scores['weighted'] = weighted_overlap_scores(suggestion_matrix, diagnosis_matrix, case_rows, weights)
+
+    # One column per metric and suggestion rank
+    output_df = pd.DataFrame({'case_id': scored_df['case_id'].to_numpy()})
+    for name, values in scores.items():
+        ranked = values.reshape(-1, MAX_SUGGESTIONS)
+        for rank in range(MAX_SUGGESTIONS):
+            output_df[f'{name}_{rank + 1}'] = ranked[:, rank]
+    output_df['suggestion_count'] = suggestion_counts[parsed_mask].to_numpy()
+
+    metrics.inc('rows_processed', len(output_df))
+    metrics.inc('rows_unparsed', len(joined_df) - len(output_df))
+
+    # Write the output DataFrame to a new CSV file
+    output_df.to_csv(output_csv_file, index=False)
+    return output_df
+
+# Command line entry point of the script
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Score the LLM suggestions against the real diagnosis.")
+    parser.add_argument("--answers", default="llama_answers.csv", help="CSV with the LLM suggestions")
+    parser.add_argument("--cases", default="cases_diagnosis_cleaned_relevant.csv",
+                        help="CSV, Parquet or Arrow file with the cleaned diagnosis of the cases")
+    parser.add_argument("--output", default="cases_with_binary_similarity_scores.csv",
+                        help="CSV that will contain the binary similarity scores")
+    parser.add_argument("--graded", nargs='*', default=[], choices=GRADED_METRICS,
+                        help="Also write graded scores: jaccard_k (Jaccard index) and/or weighted_k "
+                             "(IDF-weighted share of the diagnosis terms)")
+    add_instrumentation_arguments(parser)
+    args = parser.parse_args(argv)
+
+    with instrument_stage('score', args.metrics, args.profile, args.trace_memory):
+        output_df = score_answers(args.answers, args.cases, args.output, graded_metrics=args.graded)
+
+    # Optionally, print the first few records for inspection
+    print(output_df.head())
 
-# Load the datasets
-answers_df = pd.read_csv('llama_answers.csv')
-cases_df = pd.read_csv('cases_diagnosis_cleaned_relevant.csv')
-
-# Create list to hold the results
-rows_output = []
-
-# Iterate over each row from 'answers.csv' and 'cases_diagnosis_cleaned_relevant.csv'
-for idx, row in answers_df.iterrows():
-    llama_suggestions = row['llama_suggestions']
-    diagnoses = extract_diagnoses_from_llamasuggestions(llama_suggestions)
-
-    # Proceed only if 5 diagnoses were extracted successfully
-    if diagnoses:
-        # Find the case in cases_df using matching 'pre_diagnosis'
-        case_row = cases_df.loc[cases_df['pre_diagnosis'] == row['pre_diagnosis']]
-
-        if not case_row.empty:
-            case_diagnosis = case_row.iloc[0]['diagnosis']
-            case_id = case_row.iloc[0]['case_id']
-
-            # Clean and extract relevant terms for both suggestions and actual diagnosis
-            cleaned_suggestions = [extract_relevant_terms(diag) for diag in diagnoses]
-            cleaned_case_diagnosis = extract_relevant_terms(case_diagnosis)
-
-            # Compare each suggestion against the real diagnosis using set intersection
-            results = []
-            for suggestion in cleaned_suggestions:
-                # Use set intersection to check for any common terms between suggestion and actual diagnosis
-                if suggestion & cleaned_case_diagnosis:  # If there's overlap in the sets
-                    results.append(1)
-                else:
-                    results.append(0)
-
-            # Append results to the output
-            row_output = {
-                'case_id': case_id,
-                'match_1': results[0],
-                'match_2': results[1],
-                'match_3': results[2],
-                'match_4': results[3],
-                'match_5': results[4]
-            }
-                
-            rows_output.append(row_output)
-
-# Convert the results into a DataFrame
-output_df = pd.DataFrame(rows_output)
-
-# Write the output DataFrame to a new CSV file
-output_csv_file = 'cases_with_binary_similarity_scores.csv'
-output_df.to_csv(output_csv_file, index=False)
-
-# Optionally, print the first few records for inspection
-print(output_df.head())
\ No newline at end of file
+if __name__ == '__main__':
+    main()
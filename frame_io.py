@@ -0,0 +1,175 @@
+import os  # For file extensions
+import sys  # For the command line arguments
+import pandas as pd
+
+# File extensions of the supported columnar formats, anything else is read and written as CSV
+PARQUET_EXTENSIONS = ('.parquet',)
+ARROW_EXTENSIONS = ('.arrow', '.feather', '.ipc')
+
+# Function to tell the format of a file from its extension ('csv', 'parquet' or 'arrow')
+def frame_format(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension in PARQUET_EXTENSIONS:
+        return 'parquet'
+    if extension in ARROW_EXTENSIONS:
+        return 'arrow'
+    return 'csv'
+
+# pyarrow is only needed for the columnar formats, so it is imported on first use
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+        import pyarrow.feather
+        import pyarrow.ipc
+    except ImportError as e:
+        raise ImportError("Parquet and Arrow files require pyarrow (pip install pyarrow)") from e
+    return pyarrow
+
+# Function to read a whole table, loading only `columns` when given.
+# Parquet and Arrow files are memory-mapped instead of being read into a buffer.
+def read_frame(path, columns=None):
+    file_format = frame_format(path)
+    if file_format == 'csv':
+        return pd.read_csv(path, usecols=columns)
+    pa = _import_pyarrow()
+    if file_format == 'parquet':
+        table = pa.parquet.read_table(path, columns=columns, memory_map=True)
+    else:
+        table = pa.feather.read_table(path, columns=columns, memory_map=True)
+    return table.to_pandas()
+
+# Function to read a table in chunks of about `chunksize` rows, loading only `columns` when given
+def iter_frames(path, chunksize, columns=None, **csv_options):
+    file_format = frame_format(path)
+    if file_format == 'csv':
+        yield from pd.read_csv(path, usecols=columns, chunksize=chunksize, **csv_options)
+        return
+    pa = _import_pyarrow()
+    if file_format == 'parquet':
+        parquet_file = pa.parquet.ParquetFile(path, memory_map=True)
+        for batch in parquet_file.iter_batches(batch_size=chunksize, columns=columns):
+            yield batch.to_pandas()
+    else:
+        with pa.memory_map(path, 'r') as source:
+            reader = pa.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                batch = reader.get_batch(i)
+                if columns is not None:
+                    batch = batch.select(columns)
+                yield batch.to_pandas()
+
+# Function to return the narrowest type holding the values of both types (None when there is no type yet)
+def _widen_type(current_type, new_type):
+    if current_type is None or current_type == new_type:
+        return new_type
+    pa = _import_pyarrow()
+    return pa.unify_schemas([pa.schema([pa.field('column', current_type)]), pa.schema([pa.field('column', new_type)])],
+                            promote_options='permissive').field('column').type
+
+class FrameWriter:
+    """
+    Writes a table chunk by chunk to a CSV, Parquet or Arrow IPC file.
+
+    The first chunk fixes the header (CSV). Parquet and Arrow files need the schema
+    before the first row is written, so chunks are held back while a column has only
+    held nulls, whose type cannot be inferred yet (e.g. a sparse column that is empty
+    in the first chunk). The file is opened once every column has a type or after
+    `max_buffered_rows` rows, columns still without any value being typed as strings.
+
+    pandas infers the types of every chunk separately, so the types of the chunks held
+    back are widened to a common one (e.g. int64 and double give double), and integer
+    columns are stored as double since a later chunk may hold fractional values.
+    Every chunk is then cast to that schema.
+    """
+
+    def __init__(self, path, max_buffered_rows=100000):
+        self.path = path
+        self.format = frame_format(path)
+        self.max_buffered_rows = max_buffered_rows
+        self._writer = None
+        self._schema = None
+        self._column_types = {}
+        self._buffered = []
+        self._buffered_rows = 0
+        self._header_written = False
+
+    def write(self, df):
+        if self.format == 'csv':
+            df.to_csv(self.path, mode='a' if self._header_written else 'w', header=not self._header_written, index=False)
+            self._header_written = True
+            return
+        pa = _import_pyarrow()
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if self._writer is not None:
+            self._writer.write_table(self._conform(table))
+            return
+
+        # Hold the chunk back until the type of every column is known
+        self._buffered.append(table)
+        self._buffered_rows += table.num_rows
+        for name, column in zip(table.column_names, table.columns):
+            if column.null_count < len(column):
+                self._column_types[name] = _widen_type(self._column_types.get(name), column.type)
+        if all(name in self._column_types for name in table.column_names) \
+                or self._buffered_rows >= self.max_buffered_rows:
+            self._open()
+
+    # Function to create the file with the resolved schema and write the chunks held back so far
+    def _open(self):
+        pa = _import_pyarrow()
+        names = self._buffered[0].column_names
+        self._schema = pa.schema([pa.field(name, self._column_types.get(name, pa.string())) for name in names])
+        self._schema = pa.schema([pa.field(field.name, pa.float64()) if pa.types.is_integer(field.type) else field
+                                  for field in self._schema])
+        if self.format == 'parquet':
+            self._writer = pa.parquet.ParquetWriter(self.path, self._schema)
+        else:
+            self._writer = pa.ipc.new_file(self.path, self._schema)
+        for table in self._buffered:
+            self._writer.write_table(self._conform(table))
+        self._buffered = []
+        self._buffered_rows = 0
+
+    # Function to cast a chunk to the schema of the file, all-null columns take the type of the schema
+    def _conform(self, table):
+        pa = _import_pyarrow()
+        columns = []
+        for field in self._schema:
+            column = table.column(field.name)
+            if column.null_count == len(column):
+                column = pa.chunked_array([pa.nulls(len(column), type=field.type)])
+            columns.append(column.cast(field.type))
+        return pa.Table.from_arrays(columns, schema=self._schema)
+
+    def close(self):
+        if self._writer is None and self._buffered:
+            self._open()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+# Function to write a whole table at once
+def write_frame(df, path):
+    with FrameWriter(path) as writer:
+        writer.write(df)
+
+# Converts tables between formats, e.g. to export the columnar intermediates back to CSV:
+# python frame_io.py cases_diagnosis_cleaned_relevant.parquet cases_diagnosis_cleaned_relevant.csv
+def main(argv=None):
+    paths = sys.argv[1:] if argv is None else argv
+    if not paths or len(paths) % 2:
+        print("Usage: python frame_io.py SOURCE DESTINATION [SOURCE DESTINATION ...]")
+        sys.exit(1)
+    for source, destination in zip(paths[::2], paths[1::2]):
+        write_frame(read_frame(source), destination)
+        print(f"Exported {source} to {destination}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+import sqlite3  # For the persistent on-disk store
+import hashlib  # For hashing the request parameters into a key
+import json  # For serializing the request parameters
+import threading  # For sharing one connection between worker threads
+import time  # For tracking when an entry was last used
+
+
+# Function to build the cache key from everything that influences the LLM answer
+def make_cache_key(model, prompt, temperature, top_p, max_tokens):
+    key_data = json.dumps([model, prompt, temperature, top_p, max_tokens], ensure_ascii=False)
+    return hashlib.sha256(key_data.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+    Persistent content-addressed cache of LLM responses stored in a SQLite file.
+
+    Entries are keyed by make_cache_key(). When the stored responses grow over
+    `max_bytes`, the least recently used entries are evicted.
+    """
+
+    def __init__(self, path='llama_cache.sqlite', max_bytes=512 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # The connection is shared by the query threads, access is serialized with the lock
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self._conn.commit()
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    # Function to look up a response, returns None on a miss
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            return row[0]
+
+    # Function to store a response and evict old entries when the cache is over its size limit
+    def put(self, key, response):
+        size = len(key) + len(response.encode('utf-8'))
+        with self._lock:
+            previous = self._conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            if previous is not None:
+                self._total_bytes -= previous[0]
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, response, size, time.time()),
+            )
+            self._total_bytes += size
+            self._evict()
+            self._conn.commit()
+
+    # Function to drop the least recently used entries until the cache fits in max_bytes
+    def _evict(self):
+        if self.max_bytes is None or self._total_bytes <= self.max_bytes:
+            return
+        cursor = self._conn.execute("SELECT key, size FROM responses ORDER BY last_used ASC")
+        to_delete = []
+        for key, size in cursor:
+            if self._total_bytes <= self.max_bytes:
+                break
+            to_delete.append((key,))
+            self._total_bytes -= size
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", to_delete)
+
+    # Function to summarize the cache usage of this run
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return {'hits': self.hits, 'misses': self.misses, 'entries': entries, 'bytes': self._total_bytes}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,192 @@
+import json  # For the JSON lines export
+import os  # For the process id
+import random  # For sampling the observations kept for the quantiles
+import threading  # For updating the metrics from several threads
+import time  # For the timers and timestamps
+from contextlib import contextmanager  # For the timer and stage context managers
+
+# Number of observations kept per summary to estimate its quantiles
+MAX_SAMPLES = 2048
+
+# Quantiles reported for every summary
+QUANTILES = (0.5, 0.95, 0.99)
+
+class Summary:
+    """
+    Count, sum, min and max of a series of observations (e.g. request latencies), with a
+    uniform reservoir sample of at most MAX_SAMPLES values for the quantiles.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        self.samples = []
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        if len(self.samples) < MAX_SAMPLES:
+            self.samples.append(value)
+        else:
+            # Reservoir sampling keeps every observation with the same probability
+            slot = random.randrange(self.count)
+            if slot < MAX_SAMPLES:
+                self.samples[slot] = value
+
+    def quantiles(self):
+        ordered = sorted(self.samples)
+        if not ordered:
+            return {}
+        return {q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] for q in QUANTILES}
+
+class Metrics:
+    """
+    Thread-safe registry of counters (monotonic totals), gauges (last value) and
+    summaries (series of observations, e.g. durations in seconds).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.summaries = {}
+
+    def inc(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    def observe(self, name, value):
+        with self._lock:
+            summary = self.summaries.get(name)
+            if summary is None:
+                summary = self.summaries[name] = Summary()
+            summary.observe(value)
+
+    # Times the enclosed block and records the duration in the summary `name`
+    @contextmanager
+    def timer(self, name):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start_time)
+
+    # Function to add the counters of another process (e.g. a pool worker) to this registry
+    def merge_counters(self, counters):
+        with self._lock:
+            for name, value in counters.items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.summaries.clear()
+
+    # Function to return one JSON-serializable record per metric
+    def records(self, stage=None):
+        timestamp = time.strftime('%Y-%m-%dT%H:%M:%S')
+        records = []
+        with self._lock:
+            for name, value in sorted(self.counters.items()):
+                records.append({'name': name, 'type': 'counter', 'value': value})
+            for name, value in sorted(self.gauges.items()):
+                records.append({'name': name, 'type': 'gauge', 'value': value})
+            for name, summary in sorted(self.summaries.items()):
+                record = {'name': name, 'type': 'summary', 'count': summary.count, 'sum': summary.sum,
+                          'min': summary.min, 'max': summary.max}
+                record.update({f'p{round(q * 100)}': value for q, value in summary.quantiles().items()})
+                records.append(record)
+        for record in records:
+            record.update({'timestamp': timestamp, 'stage': stage, 'pid': os.getpid()})
+        return records
+
+    # Function to render the metrics in the Prometheus text exposition format
+    def prometheus_text(self, stage=None, prefix='pipeline_'):
+        labels = f'{{stage="{stage}"}}' if stage else ''
+        lines = []
+        for record in self.records(stage):
+            name = prefix + record['name']
+            if record['type'] == 'counter':
+                lines += [f'# TYPE {name}_total counter', f'{name}_total{labels} {record["value"]}']
+            elif record['type'] == 'gauge':
+                lines += [f'# TYPE {name} gauge', f'{name}{labels} {record["value"]}']
+            else:
+                lines.append(f'# TYPE {name} summary')
+                for q in QUANTILES:
+                    value = record.get(f'p{round(q * 100)}')
+                    if value is not None:
+                        quantile_labels = f'{{stage="{stage}",quantile="{q}"}}' if stage else f'{{quantile="{q}"}}'
+                        lines.append(f'{name}{quantile_labels} {value}')
+                lines += [f'{name}_sum{labels} {record["sum"]}', f'{name}_count{labels} {record["count"]}']
+        return '\n'.join(lines) + '\n'
+
+    # Function to export the metrics to `path`: files ending in .prom are overwritten with the
+    # Prometheus text format (one file per stage, as read by a textfile collector), anything
+    # else gets one JSON line per metric appended
+    def export(self, path, stage=None):
+        if path.endswith('.prom'):
+            temporary_path = path + '.tmp'
+            with open(temporary_path, 'w', encoding='utf-8') as file:
+                file.write(self.prometheus_text(stage))
+            os.replace(temporary_path, path)
+            return
+        with open(path, 'a', encoding='utf-8') as file:
+            for record in self.records(stage):
+                file.write(json.dumps(record) + '\n')
+
+# Registry shared by all the modules of a process
+metrics = Metrics()
+
+# Function to add the --metrics, --profile and --trace-memory options to a stage script
+def add_instrumentation_arguments(parser):
+    parser.add_argument("--metrics", default=None, metavar='FILE',
+                        help="Export timers and counters to FILE (Prometheus text for .prom, JSON lines otherwise)")
+    parser.add_argument("--profile", default=None, metavar='FILE',
+                        help="Profile the stage with cProfile, save the stats to FILE and print the top functions")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="Trace memory allocations with tracemalloc and print the largest ones")
+
+# Runs the enclosed stage with the optional profilers and exports its metrics at the end.
+# Nothing is profiled or written unless the matching options are given.
+@contextmanager
+def instrument_stage(stage, metrics_file=None, profile_file=None, trace_memory=False):
+    profiler = None
+    if profile_file:
+        import cProfile
+        profiler = cProfile.Profile()
+    if trace_memory:
+        import tracemalloc
+        tracemalloc.start()
+    if profiler is not None:
+        profiler.enable()
+    start_time = time.perf_counter()
+    try:
+        yield metrics
+    finally:
+        metrics.observe('stage_seconds', time.perf_counter() - start_time)
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_file)
+            import pstats
+            print(f"\nProfile of the {stage} stage saved to {profile_file}, top functions:")
+            pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
+        if trace_memory:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            metrics.set('traced_memory_peak_bytes', peak)
+            print(f"\nTraced memory of the {stage} stage: {current / 1024 / 1024:.1f} MB current, "
+                  f"{peak / 1024 / 1024:.1f} MB peak. Largest allocations:")
+            for statistic in snapshot.statistics('lineno')[:10]:
+                print(statistic)
+        if metrics_file:
+            metrics.export(metrics_file, stage)
@@ -0,0 +1,130 @@
+import argparse  # For command line options
+import hashlib  # For picking deterministic answers per prompt
+import json  # For the NDJSON messages
+import random  # For latency jitter and error injection
+import re  # For finding the case ids of batched prompts
+import threading  # For serving in the background of a benchmark
+import time  # For latency and token rate
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Diagnoses the mock server picks its answers from
+DIAGNOSES = [
+    "Leprosy", "Tuberculosis", "Sarcoidosis", "Rheumatoid arthritis", "Psoriatic arthritis",
+    "Systemic lupus erythematosus", "Chronic osteomyelitis", "Ankylosing spondylitis", "Gout",
+    "Multiple osteochondromas", "Reactive arthritis", "Systemic sclerosis", "Soft tissue sarcoma",
+    "Juvenile idiopathic arthritis", "Osteoarthritis", "Systemic vasculitis",
+]
+
+# Pattern matching the case ids listed in a batched prompt
+CASE_ID_PATTERN = re.compile(r'^\s*(case_\d+):', re.MULTILINE)
+
+# Function to pick five diagnoses deterministically from a text
+def pick_diagnoses(text):
+    seed = int(hashlib.sha256(text.encode('utf-8')).hexdigest(), 16)
+    return random.Random(seed).sample(DIAGNOSES, 5)
+
+# Function to build the full answer text for a request payload, JSON for batched prompts
+def build_answer(payload):
+    prompt = payload.get("prompt", "")
+    if payload.get("format") == "json":
+        case_ids = CASE_ID_PATTERN.findall(prompt) or ["case_1"]
+        return json.dumps({case_id: pick_diagnoses(prompt + case_id) for case_id in case_ids})
+    return "\n".join(f"{i}. {diagnosis}" for i, diagnosis in enumerate(pick_diagnoses(prompt), start=1))
+
+# Function to split an answer into tokens of a few characters, like a tokenizer would
+def tokenize(text, chars_per_token=4):
+    return [text[i:i + chars_per_token] for i in range(0, len(text), chars_per_token)]
+
+class MockOllamaHandler(BaseHTTPRequestHandler):
+    """
+    Mimics the streaming /api/generate endpoint of Ollama. The behaviour is set by
+    the `options` dict of the server: latency and jitter before the first token,
+    token_rate (tokens per second, 0 for no delay) and error_rate (share of requests
+    answered with HTTP 500).
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    # Clients close their keep-alive connections at any time, e.g. when a run is interrupted
+    def handle(self):
+        try:
+            super().handle()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def do_POST(self):
+        if self.path != "/api/generate":
+            self.send_error(404)
+            return
+        options = self.server.options
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            payload = json.loads(self.rfile.read(length) or b"{}")
+        except json.JSONDecodeError:
+            self.send_error(400, "Invalid JSON body")
+            return
+
+        # Latency before the first token, with uniform jitter
+        time.sleep(max(0.0, options['latency'] + random.uniform(-options['jitter'], options['jitter'])))
+
+        if random.random() < options['error_rate']:
+            self.send_error(500, "Injected error")
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        model = payload.get("model", "mock")
+        tokens = tokenize(build_answer(payload))
+        token_delay = 1.0 / options['token_rate'] if options['token_rate'] else 0.0
+        try:
+            for token in tokens:
+                self._write_chunk({"model": model, "response": token, "done": False})
+                if token_delay:
+                    time.sleep(token_delay)
+            self._write_chunk({"model": model, "response": "", "done": True, "eval_count": len(tokens)})
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # The client stopped reading early (e.g. after five diagnoses)
+            self.close_connection = True
+
+    def _write_chunk(self, message):
+        data = (json.dumps(message) + "\n").encode('utf-8')
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+# Function to start a mock server in a background thread, port 0 picks a free port.
+# Returns the server, its URL is f"http://127.0.0.1:{server.server_port}".
+def start_mock_server(port=0, latency=0.0, jitter=0.0, token_rate=0.0, error_rate=0.0):
+    server = ThreadingHTTPServer(("127.0.0.1", port), MockOllamaHandler)
+    server.daemon_threads = True
+    server.options = {'latency': latency, 'jitter': jitter, 'token_rate': token_rate, 'error_rate': error_rate}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# Command line entry point of the script
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local stand-in for the Ollama /api/generate endpoint.")
+    parser.add_argument("--port", type=int, default=11434, help="Port to listen on")
+    parser.add_argument("--latency", type=float, default=0.5, help="Seconds before the first token")
+    parser.add_argument("--jitter", type=float, default=0.1, help="Uniform jitter added to the latency (seconds)")
+    parser.add_argument("--token-rate", type=float, default=50.0, help="Tokens per second, 0 streams without delay")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with HTTP 500")
+    args = parser.parse_args(argv)
+
+    server = start_mock_server(args.port, args.latency, args.jitter, args.token_rate, args.error_rate)
+    print(f"Mock Ollama listening on http://127.0.0.1:{server.server_port} (Ctrl+C to stop)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,292 @@
+import argparse  # For command line options
+import hashlib  # For fingerprinting code and data files
+import json  # For the manifest of the last successful runs
+import os  # For file metadata
+import shlex  # For splitting extra stage arguments
+import subprocess  # For running every stage as its own script
+import sys  # For the current interpreter
+import time  # For per-stage wall time
+
+# Directory holding the manifest and the console logs of the stages
+STATE_DIR = '.pipeline'
+
+# File extension of the intermediate tables for every supported format
+INTERMEDIATE_EXTENSIONS = {'csv': '.csv', 'parquet': '.parquet', 'arrow': '.arrow'}
+
+# Function to build the stages of the workflow, exchanging the intermediate tables in the given
+# format. Dependencies are derived from matching outputs to inputs, `code` lists the local files
+# whose changes must re-run the stage and `args` the paths passed to the script.
+def build_stages(intermediate_format='csv'):
+    extension = INTERMEDIATE_EXTENSIONS[intermediate_format]
+    diagnosed = 'cases_with_diagnosis' + extension
+    separated = 'cases_with_separated_diagnosis_truncated' + extension
+    cleaned = 'cases_diagnosis_cleaned_relevant' + extension
+    stages = [
+        {
+            'name': 'separate',
+            'script': 'separator.py',
+            'code': ['separator.py', 'frame_io.py', 'metrics.py'],
+            'inputs': ['cases.csv'],
+            'outputs': [diagnosed],
+            'args': ['--input', 'cases.csv', '--output', diagnosed],
+        },
+        {
+            'name': 'split',
+            'script': 'split_diagnosis.py',
+            'code': ['split_diagnosis.py', 'frame_io.py', 'metrics.py'],
+            'inputs': [diagnosed],
+            'outputs': [separated],
+            'args': ['--input', diagnosed, '--output', separated],
+        },
+        {
+            'name': 'stem',
+            'script': 'stem_data.py',
+            'code': ['stem_data.py', 'text_normalizer.py', 'frame_io.py', 'metrics.py'],
+            'inputs': [separated],
+            'outputs': [cleaned],
+            'args': ['--input', separated, '--output', cleaned],
+        },
+        {
+            # run_llama.py resumes from its existing output, so only new rows are queried
+            'name': 'query',
+            'script': 'run_llama.py',
+            'code': ['run_llama.py', 'llm_cache.py', 'checkpoint.py', 'frame_io.py', 'metrics.py'],
+            'inputs': [cleaned],
+            'outputs': ['llama_answers.csv'],
+            'args': ['--input', cleaned, '--output', 'llama_answers.csv'],
+        },
+        {
+            'name': 'score',
+            'script': 'extract_results.py',
+            'code': ['extract_results.py', 'text_normalizer.py', 'medical_terms.json', 'frame_io.py', 'metrics.py'],
+            'inputs': ['llama_answers.csv', cleaned],
+            'outputs': ['cases_with_binary_similarity_scores.csv'],
+            'args': ['--answers', 'llama_answers.csv', '--cases', cleaned,
+                     '--output', 'cases_with_binary_similarity_scores.csv'],
+        },
+        {
+            'name': 'stats',
+            'script': 'print_final_statistics.py',
+            'code': ['print_final_statistics.py', 'frame_io.py', 'metrics.py'],
+            'inputs': ['cases_with_binary_similarity_scores.csv', cleaned],
+            'outputs': [],
+            'args': ['cases_with_binary_similarity_scores.csv', '--cases', cleaned],
+        },
+    ]
+    if intermediate_format != 'csv':
+        # The columnar intermediates are exported back to CSV as the final step
+        intermediates = [diagnosed, separated, cleaned]
+        csv_exports = [os.path.splitext(path)[0] + '.csv' for path in intermediates]
+        stages.append({
+            'name': 'export',
+            'script': 'frame_io.py',
+            'code': ['frame_io.py'],
+            'inputs': intermediates,
+            'outputs': csv_exports,
+            'args': [path for pair in zip(intermediates, csv_exports) for path in pair],
+        })
+    return stages
+
+# Names of all the stages, the export stage only exists for columnar intermediates
+STAGE_NAMES = [stage['name'] for stage in build_stages('parquet')]
+
+# Function to order the stages so that every stage comes after the stages producing its inputs
+def topological_order(stages):
+    producers = {output: stage['name'] for stage in stages for output in stage['outputs']}
+    dependencies = {stage['name']: {producers[path] for path in stage['inputs'] if path in producers}
+                    for stage in stages}
+    by_name = {stage['name']: stage for stage in stages}
+    ordered = []
+    remaining = dict(dependencies)
+    while remaining:
+        ready = [name for name, deps in remaining.items() if not deps - {stage['name'] for stage in ordered}]
+        if not ready:
+            raise ValueError(f"Cyclic stage dependencies: {', '.join(remaining)}")
+        # Keep the declaration order among the stages that are ready
+        for name in sorted(ready, key=lambda name: list(by_name).index(name)):
+            ordered.append(by_name[name])
+            del remaining[name]
+    return ordered, dependencies
+
+# Function to select the stages needed to build `target` (all stages when target is None)
+def stages_for_target(ordered, dependencies, target):
+    if target is None:
+        return ordered
+    needed = set()
+    pending = [target]
+    while pending:
+        name = pending.pop()
+        if name not in needed:
+            needed.add(name)
+            pending.extend(dependencies[name])
+    return [stage for stage in ordered if stage['name'] in needed]
+
+class FileHasher:
+    """
+    Hashes files with SHA-256, reusing the previous hash of a file whose size and
+    modification time did not change, so large unchanged files are not read again.
+    """
+
+    def __init__(self, known=None):
+        self.known = dict(known or {})
+
+    def hash(self, path):
+        if not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        signature = [stat.st_size, stat.st_mtime_ns]
+        known = self.known.get(path)
+        if known is not None and known['signature'] == signature:
+            return known['sha256']
+        digest = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(1024 * 1024), b''):
+                digest.update(block)
+        self.known[path] = {'signature': signature, 'sha256': digest.hexdigest()}
+        return self.known[path]['sha256']
+
+# Function to fingerprint a stage from its code, its inputs and its extra arguments
+def stage_fingerprint(stage, hasher, extra_args):
+    parts = {
+        'code': {path: hasher.hash(path) for path in stage['code']},
+        'inputs': {path: hasher.hash(path) for path in stage['inputs']},
+        'args': stage['args'] + extra_args,
+    }
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+# Function to load the manifest of the previous runs
+def load_manifest(path):
+    if not os.path.exists(path):
+        return {'stages': {}, 'files': {}}
+    with open(path, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+# Function to save the manifest atomically
+def save_manifest(path, manifest):
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'w', encoding='utf-8') as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+    os.replace(temporary_path, path)
+
+# Function to run a stage script, echoing its output and saving it to a log file
+def run_stage_script(stage, extra_args, log_path):
+    command = [sys.executable, stage['script']] + stage['args'] + extra_args
+    with open(log_path, 'w', encoding='utf-8') as log_file:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        for line in process.stdout:
+            print(line, end='')
+            log_file.write(line)
+        return process.wait()
+
+# Main function to run the stages whose code or inputs changed since their last successful run
+def run_pipeline(target=None, force=(), stage_args=None, dry_run=False, intermediate_format='csv'):
+    stage_args = stage_args or {}
+    os.makedirs(STATE_DIR, exist_ok=True)
+    manifest_path = os.path.join(STATE_DIR, 'manifest.json')
+    manifest = load_manifest(manifest_path)
+    hasher = FileHasher(manifest.get('files'))
+
+    ordered, dependencies = topological_order(build_stages(intermediate_format))
+    if target is not None and target not in dependencies:
+        raise ValueError(f"Stage '{target}' does not exist with {intermediate_format} intermediates")
+    report = []
+    # Stages that would run in a dry run, their inputs may change so their descendants may run too
+    would_run = set()
+    for stage in stages_for_target(ordered, dependencies, target):
+        name = stage['name']
+        extra_args = stage_args.get(name, [])
+        log_path = os.path.join(STATE_DIR, f'{name}.log')
+
+        if dry_run and dependencies[name] & would_run:
+            print(f"[{name}] may run, depends on {', '.join(sorted(dependencies[name] & would_run))}")
+            report.append((name, 'may run', 0.0))
+            would_run.add(name)
+            continue
+
+        missing_inputs = [path for path in stage['inputs'] if not os.path.exists(path)]
+
+        # Without its inputs a stage can only reuse the outputs that are already there
+        if missing_inputs:
+            if all(os.path.exists(path) for path in stage['outputs']):
+                print(f"[{name}] missing {', '.join(missing_inputs)}, using the existing outputs")
+                report.append((name, 'existing', 0.0))
+                continue
+            print(f"[{name}] cannot run, missing {', '.join(missing_inputs)}")
+            report.append((name, 'failed', 0.0))
+            break
+
+        fingerprint = stage_fingerprint(stage, hasher, extra_args)
+        previous = manifest['stages'].get(name, {})
+        outputs_unchanged = all(hasher.hash(path) is not None and hasher.hash(path) == previous.get('outputs', {}).get(path)
+                                for path in stage['outputs'])
+        if name not in force and previous.get('fingerprint') == fingerprint and outputs_unchanged:
+            print(f"[{name}] up to date, reusing cached artifacts")
+            # Replay the console output of the cached run
+            if os.path.exists(log_path) and not stage['outputs']:
+                with open(log_path, 'r', encoding='utf-8') as log_file:
+                    print(log_file.read(), end='')
+            report.append((name, 'cached', 0.0))
+            continue
+
+        if dry_run:
+            print(f"[{name}] would run")
+            report.append((name, 'outdated', 0.0))
+            would_run.add(name)
+            continue
+
+        print(f"[{name}] running {stage['script']} {' '.join(stage['args'] + extra_args)}")
+        start_time = time.time()
+        return_code = run_stage_script(stage, extra_args, log_path)
+        elapsed = time.time() - start_time
+        if return_code != 0:
+            print(f"[{name}] failed with exit code {return_code}")
+            report.append((name, 'failed', elapsed))
+            break
+
+        manifest['stages'][name] = {
+            'fingerprint': fingerprint,
+            'outputs': {path: hasher.hash(path) for path in stage['outputs']},
+            'seconds': elapsed,
+        }
+        manifest['files'] = hasher.known
+        save_manifest(manifest_path, manifest)
+        report.append((name, 'ran', elapsed))
+
+    manifest['files'] = hasher.known
+    save_manifest(manifest_path, manifest)
+
+    # Print the per-stage wall time
+    print("\nStage      Status     Wall time")
+    for name, status, elapsed in report:
+        print(f"{name:<10} {status:<10} {elapsed:8.2f}s")
+    return report
+
+# Command line entry point of the script
+def main(argv=None):
+    stage_names = STAGE_NAMES
+    parser = argparse.ArgumentParser(description="Run the pipeline stages whose code or inputs changed.")
+    parser.add_argument("target", nargs='?', choices=stage_names, default=None,
+                        help="Only build this stage and the stages it depends on")
+    parser.add_argument("--force", nargs='*', choices=stage_names, default=[],
+                        help="Re-run these stages even if they are up to date")
+    parser.add_argument("--args", action='append', default=[], metavar='STAGE=ARGS',
+                        help="Extra command line arguments for a stage, e.g. --args 'query=--concurrency 8'")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Only report which stages would run")
+    parser.add_argument("--format", choices=list(INTERMEDIATE_EXTENSIONS), default='csv',
+                        help="Format of the intermediate tables, columnar ones are exported to CSV at the end")
+    args = parser.parse_args(argv)
+
+    stage_args = {}
+    for value in args.args:
+        name, _, extra = value.partition('=')
+        if name not in stage_names:
+            parser.error(f"unknown stage in --args: {name}")
+        stage_args[name] = shlex.split(extra)
+
+    report = run_pipeline(args.target, force=set(args.force), stage_args=stage_args, dry_run=args.dry_run,
+                          intermediate_format=args.format)
+    return 1 if any(status == 'failed' for _, status, _ in report) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
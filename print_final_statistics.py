@@ -1,52 +1,136 @@
+import argparse  # For command line options
+import numpy as np
 import pandas as pd
+from frame_io import read_frame  # For CSV, Parquet or Arrow input
+from metrics import add_instrumentation_arguments, instrument_stage  # For timers and counters
 
-# Load the CSV file into a DataFrame
-df = pd.read_csv('cases_with_binary_similarity_scores.csv')
-
-# Initialize counters
-total_rows = len(df)
-total_zeros = [0] * 5
-total_ones = [0] * 5
-undetected_count = 0
-well_suggested_count = 0
-suggested_count = 0
-
-# Iterate through each row in the DataFrame
-for index, row in df.iterrows():
-    # Check if all matches from match_1 to match_5 are 0 for "undetected"
-    if row['match_1'] == 0 and row['match_2'] == 0 and row['match_3'] == 0 and row['match_4'] == 0 and row['match_5'] == 0:
-        undetected_count += 1
-    
-    # Check if the first match is 1 for "well suggested"
-    if row['match_1'] == 1:
-        well_suggested_count += 1
-    
-    # Check if at least one match from match_1 to match_5 is 1 for "suggested"
-    if row['match_1'] == 1 or row['match_2'] == 1 or row['match_3'] == 1 or row['match_4'] == 1 or row['match_5'] == 1:
-        suggested_count += 1
-
-    # Count number of 1's and 0's for each match position (match_1 to match_5)
-    for i in range(5):
-        if row[f'match_{i+1}'] == 1:
-            total_ones[i] += 1
-        else:
-            total_zeros[i] += 1
-
-# Calculate percentages for 1's and 0's in each match position
-percent_zeros = [(zeros / total_rows) * 100 for zeros in total_zeros]
-percent_ones = [(ones / total_rows) * 100 for ones in total_ones]
-
-# Calculate overall success percentages
-undetected_percentage = (undetected_count / total_rows) * 100
-well_suggested_percentage = (well_suggested_count / total_rows) * 100
-suggested_percentage = (suggested_count / total_rows) * 100
-
-# Print overall statistics
-print("Match Position Statistics (in %):")
-for i in range(5):
-    print(f"Match_{i+1}: {percent_zeros[i]:.2f}% are 0, {percent_ones[i]:.2f}% are 1")
-
-# Print success definitions
-print(f"\nUnsuggested (all zeros): {undetected_percentage:.2f}%")
-print(f"Well suggested (first match is 1): {well_suggested_percentage:.2f}%")
-print(f"Suggested (at least one match is 1): {suggested_percentage:.2f}%")
\ No newline at end of file
+# Age bands used for the group-by breakdown on 'age'
+AGE_BINS = [0, 18, 40, 65, np.inf]
+AGE_LABELS = ['0-17', '18-39', '40-64', '65+']
+
+# Function to build the (n x k) boolean match matrix from the match_1 ... match_k columns
+def match_matrix(df):
+    match_columns = sorted((column for column in df.columns if column.startswith('match_')),
+                           key=lambda column: int(column.split('_')[1]))
+    return df[match_columns].to_numpy() == 1
+
+# Function to compute, for every row, the rank (1-based) of the first match, or 0 when nothing matched
+def first_match_ranks(matches):
+    any_match = matches.any(axis=1)
+    return np.where(any_match, matches.argmax(axis=1) + 1, 0)
+
+# Function to build the table of metrics for every possible first-match rank (0 = no match).
+# Every per-row metric only depends on that rank, so row r holds the metrics of a row with rank r.
+def rank_metric_table(k):
+    ranks = np.arange(k + 1)
+    columns = {f'top_{i}': (ranks >= 1) & (ranks <= i) for i in range(1, k + 1)}
+    columns['mrr'] = np.where(ranks > 0, 1.0 / np.maximum(ranks, 1), 0.0)
+    return list(columns), np.column_stack([columns[name].astype(float) for name in columns])
+
+# Function to compute percentile bootstrap confidence intervals of the metric means.
+# Resampling rows with replacement is the same as drawing multinomial counts of the ranks,
+# so all resamples are drawn at once as an (n_boot x ranks) count matrix, whatever the number of rows.
+def bootstrap_ci(rank_counts, table, n_boot=1000, alpha=0.05, seed=0):
+    rng = np.random.default_rng(seed)
+    n = rank_counts.sum()
+    boot_counts = rng.multinomial(n, rank_counts / n, size=n_boot)  # (n_boot x ranks)
+    boot_means = boot_counts @ table / n  # (n_boot x metrics)
+    lower = np.percentile(boot_means, 100 * alpha / 2, axis=0)
+    upper = np.percentile(boot_means, 100 * (1 - alpha / 2), axis=0)
+    return lower, upper
+
+# Function to summarize a match matrix into one row of statistics (in %, MRR as a fraction)
+def summarize(matches, n_boot=1000, alpha=0.05):
+    n, k = matches.shape
+    names, table = rank_metric_table(k)
+    rank_counts = np.bincount(first_match_ranks(matches), minlength=k + 1)
+    means = rank_counts @ table / max(n, 1)
+    summary = {'cases': n}
+    for i, rate in enumerate(matches.mean(axis=0)):
+        summary[f'match_{i + 1}'] = rate * 100
+    if n_boot and n:
+        lower, upper = bootstrap_ci(rank_counts, table, n_boot=n_boot, alpha=alpha)
+    for j, name in enumerate(names):
+        scale = 1 if name == 'mrr' else 100
+        summary[name] = means[j] * scale
+        if n_boot and n:
+            summary[f'{name}_ci_low'] = lower[j] * scale
+            summary[f'{name}_ci_high'] = upper[j] * scale
+    return summary
+
+# Function to compute the statistics per group of a case attribute ('gender' or 'age')
+def group_breakdown(scores_df, cases_df, by, n_boot=0):
+    merged = scores_df.merge(cases_df[['case_id', by]].drop_duplicates('case_id'), on='case_id', how='left')
+    if by == 'age':
+        merged['age'] = pd.cut(merged['age'], bins=AGE_BINS, labels=AGE_LABELS, right=False)
+    rows = {}
+    for group, group_df in merged.groupby(by, observed=True, dropna=False):
+        rows[group] = summarize(match_matrix(group_df), n_boot=n_boot)
+    return pd.DataFrame.from_dict(rows, orient='index').rename_axis(by)
+
+# Function to print the statistics of a single scores file
+def print_statistics(matches, summary, alpha=0.05):
+    k = matches.shape[1]
+
+    # Print overall statistics
+    print("Match Position Statistics (in %):")
+    for i in range(k):
+        ones = summary[f'match_{i + 1}']
+        print(f"Match_{i+1}: {100 - ones:.2f}% are 0, {ones:.2f}% are 1")
+
+    # Print success definitions
+    print(f"\nUnsuggested (all zeros): {100 - summary[f'top_{k}']:.2f}%")
+    print(f"Well suggested (first match is 1): {summary['top_1']:.2f}%")
+    print(f"Suggested (at least one match is 1): {summary[f'top_{k}']:.2f}%")
+
+    # Print ranking metrics with their bootstrap confidence intervals when available
+    confidence = f"{(1 - alpha) * 100:.0f}% CI"
+    print("\nRanking metrics:")
+    for name in [f'top_{i}' for i in range(1, k + 1)] + ['mrr']:
+        unit = '' if name == 'mrr' else '%'
+        line = f"{name}: {summary[name]:.{4 if name == 'mrr' else 2}f}{unit}"
+        if f'{name}_ci_low' in summary:
+            line += (f" ({confidence} {summary[f'{name}_ci_low']:.{4 if name == 'mrr' else 2}f}"
+                     f" - {summary[f'{name}_ci_high']:.{4 if name == 'mrr' else 2}f}{unit})")
+        print(line)
+
+# Command line entry point of the script
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Print the statistics of the binary similarity scores.")
+    parser.add_argument("scores", nargs='*', default=['cases_with_binary_similarity_scores.csv'],
+                        help="One or more score CSVs (e.g. one per model variant)")
+    parser.add_argument("--cases", default="cases_diagnosis_cleaned_relevant.csv",
+                        help="Case CSV, Parquet or Arrow file with the gender and age columns used by --group-by")
+    parser.add_argument("--group-by", nargs='*', default=[], choices=['gender', 'age'],
+                        help="Also print the statistics per gender and/or age band")
+    parser.add_argument("--bootstrap", type=int, default=1000,
+                        help="Number of bootstrap resamples for the confidence intervals (0 disables them)")
+    parser.add_argument("--alpha", type=float, default=0.05,
+                        help="Significance level of the confidence intervals")
+    add_instrumentation_arguments(parser)
+    args = parser.parse_args(argv)
+
+    with instrument_stage('stats', args.metrics, args.profile, args.trace_memory):
+        cases_df = read_frame(args.cases, columns=['case_id', 'gender', 'age']) if args.group_by else None
+        summaries = {}
+        for scores_file in args.scores:
+            # Load the CSV file into a DataFrame
+            df = pd.read_csv(scores_file)
+            matches = match_matrix(df)
+            summaries[scores_file] = summarize(matches, n_boot=args.bootstrap, alpha=args.alpha)
+
+            if len(args.scores) > 1:
+                print(f"\n=== {scores_file} ===")
+            print_statistics(matches, summaries[scores_file], alpha=args.alpha)
+
+            for by in args.group_by:
+                print(f"\nBreakdown by {by}:")
+                print(group_breakdown(df, cases_df, by).round(2).to_string())
+
+        # Side-by-side comparison when several score files are given
+        if len(args.scores) > 1:
+            print("\nComparison:")
+            print(pd.DataFrame.from_dict(summaries, orient='index').round(2).to_string())
+
+if __name__ == '__main__':
+    main()
@@ -1,133 +1,482 @@
-import pandas as pd  # For reading/writing CSV files.
 import requests  # For communicating with the Ollama instance.
 import json  # For handling JSON response from the Ollama instance
-import csv  # For writing CSV row by row
 import os  # For checking if the output file exists
+import sys  # For the exit code
+import time  # For retry backoff and throughput reporting
+import argparse  # For command line options
+import re  # For recognizing numbered diagnoses in the stream
+import threading  # For creating the shared session only once
+from requests.adapters import HTTPAdapter  # For sizing the keep-alive connection pool
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED  # For keeping several requests in flight
+from llm_cache import ResponseCache, make_cache_key  # For reusing answers of already queried prompts
+from checkpoint import CheckpointJournal, make_row_keys  # For crash-safe resumable output
+from frame_io import read_frame  # For CSV, Parquet or Arrow input
+from metrics import metrics, add_instrumentation_arguments, instrument_stage  # For timers and counters
 
-# Function to send a request and handle streaming response
-def query_llama(pre_diagnosis_text):
-    # Local Ollama instance URL
-    url = "http://192.168.16.64:11434/api/generate"
-    # Construct the custom prompt
-    prompt = f"""
+# Ollama instance and model, can be overridden with the OLLAMA_URL / OLLAMA_MODEL environment
+# variables or the --url / --model options
+OLLAMA_URL = os.environ.get("OLLAMA_URL", "http://192.168.16.64:11434")
+MODEL = os.environ.get("OLLAMA_MODEL", "llama3.2-vision:90b")
+
+class LlamaRequestError(Exception):
+    """
+    Raised when the LLM could not be queried (after all retries) or sent an invalid answer.
+    Failed rows are neither cached nor journaled, so they are queried again on the next run.
+    """
+
+# Default prompt, {pre_diagnosis_text} is replaced with the case text
+PROMPT_TEMPLATE = """
     Provide the top 5 possible brief diagnoses based on the following patient information. 
     Only answer with the top 5 diagnosis wr with nothing at all, NEVER PROVIDE ANYTHING ELSE.
     Keep the responses 10 words or fewer per diagnosis:
     {pre_diagnosis_text}
     """
+
+# Function to send a request and handle streaming response
+# timeout is the time allowed for each request (seconds), failed requests are retried `retries` times
+# with an exponential backoff starting at `backoff` seconds.
+# When a ResponseCache is given it is checked before calling the network, refresh_cache
+# skips the lookup but still stores the new answer. model defaults to MODEL and
+# prompt_template to PROMPT_TEMPLATE.
+def query_llama(pre_diagnosis_text, timeout=None, retries=0, backoff=1.0, echo=True, cache=None, refresh_cache=False,
+                model=None, prompt_template=None, temperature=0.7):
+    # Construct the custom prompt
+    prompt = (prompt_template or PROMPT_TEMPLATE).replace("{pre_diagnosis_text}", pre_diagnosis_text)
     # Prepare the payload with model information and tuning options
     payload = {
-        "model": "llama3.2-vision:90b",
+        "model": model or MODEL,
         "prompt": prompt,
         "max_tokens": 200,  # Limit the response length
-        "temperature": 0.7,  # Balanced creativity vs accuracy
+        "temperature": temperature,  # Balanced creativity vs accuracy by default
         "top_p": 1.0,        # Conservative behavior
     }
+    return _send_llama_request(payload, timeout, retries, backoff, echo, cache, refresh_cache)
+
+# Function to send a payload with caching and retries, returning the response text.
+# Raises LlamaRequestError when the request still fails after the retries.
+def _send_llama_request(payload, timeout, retries, backoff, echo, cache, refresh_cache, stop_early=True):
+    # Ollama instance URL
+    url = f"{OLLAMA_URL.rstrip('/')}/api/generate"
     headers = {'Content-Type': 'application/json'}
 
+    # Look up the answer in the persistent cache before calling the network
+    cache_key = None
+    if cache is not None:
+        cache_key = make_cache_key(payload["model"], payload["prompt"], payload["temperature"],
+                                   payload["top_p"], payload["max_tokens"])
+        if not refresh_cache:
+            cached_response = cache.get(cache_key)
+            if cached_response is not None:
+                metrics.inc('llm_cache_hits')
+                return cached_response
+            metrics.inc('llm_cache_misses')
+
+    attempt = 0
+    while True:
+        metrics.inc('llm_requests')
+        try:
+            with metrics.timer('llm_request_seconds'):
+                response_text = _stream_llama_response(url, headers, payload, timeout, echo, stop_early)
+        except json.JSONDecodeError as e:
+            metrics.inc('llm_request_failures')
+            raise LlamaRequestError("Invalid JSON response received from LLM.") from e
+        except requests.exceptions.RequestException as e:
+            if attempt < retries:
+                metrics.inc('llm_retries')
+                delay = backoff * (2 ** attempt)
+                print(f"Request failed: {e}. Retrying in {delay:.1f}s ({attempt + 1}/{retries})")
+                time.sleep(delay)
+                attempt += 1
+                continue
+            print(f"Request failed: {e}")
+            metrics.inc('llm_request_failures')
+            raise LlamaRequestError(f"Request to LLM failed with error: {e}") from e
+
+        # Only successful answers are cached
+        if cache_key is not None:
+            cache.put(cache_key, response_text)
+        return response_text
+
+# Rough number of characters per prompt token, used to size the batches
+CHARS_PER_TOKEN = 4
+
+# Function to estimate the number of prompt tokens of a text
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+# Function to group the pending rows into batches whose case texts fit in `token_budget` prompt tokens.
+# A case larger than the budget gets a batch of its own.
+def make_batches(rows, token_budget):
+    batches = []
+    batch = []
+    batch_tokens = 0
+    for row in rows:
+        tokens = estimate_tokens(row[1])
+        if batch and batch_tokens + tokens > token_budget:
+            batches.append(batch)
+            batch = []
+            batch_tokens = 0
+        batch.append(row)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+# Function to validate the five diagnoses of one case in a batched JSON answer and format
+# them like a single-case answer ("1. ... 2. ..."), returns None when they are malformed
+def _format_batch_diagnoses(diagnoses):
+    if not isinstance(diagnoses, list) or len(diagnoses) != 5:
+        return None
+    if not all(isinstance(diagnosis, str) and diagnosis.strip() for diagnosis in diagnoses):
+        return None
+    return " ".join(f"{i}. {' '.join(diagnosis.split())}" for i, diagnosis in enumerate(diagnoses, start=1))
+
+# Function to query the LLM for several cases in one request, asking for a JSON object keyed by case id.
+# Cases missing or malformed in the answer are queried again one by one. A case whose query failed
+# gets its LlamaRequestError in the results instead of an answer, so the other cases are kept.
+def query_llama_batch(pre_diagnosis_texts, timeout=None, retries=0, backoff=1.0, echo=False, cache=None,
+                      refresh_cache=False, model=None, temperature=0.7):
+    if len(pre_diagnosis_texts) == 1:
+        try:
+            return [query_llama(pre_diagnosis_texts[0], timeout, retries, backoff, echo, cache, refresh_cache, model,
+                                temperature=temperature)]
+        except LlamaRequestError as e:
+            return [e]
+
+    case_ids = [f"case_{i}" for i in range(1, len(pre_diagnosis_texts) + 1)]
+    cases_text = "\n".join(f"{case_id}: {text}" for case_id, text in zip(case_ids, pre_diagnosis_texts))
+    # Construct the custom prompt
+    prompt = f"""
+    Provide the top 5 possible brief diagnoses for each of the following patients.
+    Answer ONLY with a JSON object that maps every case id to a list of exactly 5 diagnoses,
+    for example {{"case_1": ["diagnosis", "diagnosis", "diagnosis", "diagnosis", "diagnosis"]}}.
+    Keep the responses 10 words or fewer per diagnosis:
+    {cases_text}
+    """
+    payload = {
+        "model": model or MODEL,
+        "prompt": prompt,
+        "format": "json",  # Constrain the answer to valid JSON
+        "max_tokens": 200 * len(pre_diagnosis_texts),  # Limit the response length
+        "temperature": temperature,  # Balanced creativity vs accuracy by default
+        "top_p": 1.0,        # Conservative behavior
+    }
     try:
-        # Sending the POST request and handling the response with streaming
-        with requests.post(url, headers=headers, data=json.dumps(payload), stream=True) as response:
-            response.raise_for_status()  # Raise error for non-200 status codes
-            full_response = ""  # Initialize an empty string to accumulate results
+        response_text = _send_llama_request(payload, timeout, retries, backoff, echo, cache, refresh_cache,
+                                            stop_early=False)
+        answers = json.loads(response_text)
+    except (LlamaRequestError, json.JSONDecodeError):
+        # Every case is queried on its own below
+        answers = {}
+    if not isinstance(answers, dict):
+        answers = {}
+
+    results = []
+    for case_id, pre_diagnosis_text in zip(case_ids, pre_diagnosis_texts):
+        diagnosis_suggestions = _format_batch_diagnoses(answers.get(case_id))
+        if diagnosis_suggestions is None:
+            # Fall back to a single-case query for this case
+            print(f"Malformed batch answer for {case_id}, querying it on its own.")
+            try:
+                diagnosis_suggestions = query_llama(pre_diagnosis_text, timeout, retries, backoff, echo, cache,
+                                                    refresh_cache, model, temperature=temperature)
+            except LlamaRequestError as e:
+                diagnosis_suggestions = e
+        results.append(diagnosis_suggestions)
+    return results
+
+# Shared HTTP session so that all requests reuse pooled keep-alive connections
+_session = None
+_session_lock = threading.Lock()
+
+# Function to return the shared session, its pool is sized for `pool_size` concurrent requests on creation
+def get_session(pool_size=10):
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, pool_size))
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+        return _session
+
+# Pattern matching a numbered diagnosis line such as "3. Sarcoidosis"
+NUMBERED_LINE_PATTERN = re.compile(r'^\s*\d+\.\s+\S')
+
+# Function to decode a stream of byte chunks into NDJSON messages as soon as each line is complete.
+# Lines are split on the raw bytes, so multibyte UTF-8 characters split across chunks stay intact.
+def iter_ndjson(byte_chunks):
+    buffer = b""
+    for chunk in byte_chunks:
+        buffer += chunk
+        if b"\n" not in buffer:
+            continue
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield _parse_ndjson_line(line)
+    if buffer.strip():
+        yield _parse_ndjson_line(buffer)
+
+# Function to parse a single NDJSON line, printing it when it is not valid JSON
+def _parse_ndjson_line(line):
+    try:
+        return json.loads(line)
+    except json.JSONDecodeError:
+        print("Failed to parse JSON. Raw line:")
+        print(line.decode('utf-8', errors='replace'))
+        raise
+
+# Function to send a single streaming request, network errors are raised to the caller.
+# Reading stops as soon as the `done` message or, with stop_early, five complete numbered diagnoses have arrived.
+# `timeout` limits the whole request: requests only applies it to the connection and to the wait for each
+# read, so a stream still going after `timeout` seconds is cut off with a requests Timeout.
+def _stream_llama_response(url, headers, payload, timeout, echo, stop_early=True):
+    session = get_session()
+    start_time = time.perf_counter()
+    deadline = start_time + timeout if timeout else None
+    first_token_time = None
+    # Sending the POST request and handling the response with streaming
+    with session.post(url, headers=headers, data=json.dumps(payload), stream=True, timeout=timeout) as response:
+        response.raise_for_status()  # Raise error for non-200 status codes
+        response_parts = []  # Collect the tokens and join them once at the end
+        current_line = []  # Tokens of the line that is still being generated
+        numbered_lines = 0
+        if echo:
             print("Streaming response:")
-            # Stream the data and concatenate chunks as they come in
-            for chunk in response.iter_content(chunk_size=None):
-                # Decode the bytes to string and print the chunk to show streaming progress
-                chunk_text = chunk.decode('utf-8')
+        for message in iter_ndjson(response.iter_content(chunk_size=None)):
+            token = message.get("response", "")
+            response_parts.append(token)
+            if token and first_token_time is None:
+                first_token_time = time.perf_counter()
+                metrics.observe('llm_time_to_first_token_seconds', first_token_time - start_time)
 
-                # Print the chunk so user can see the progress
-                print(chunk_text, end='', flush=True)
+            # Print the token so user can see the progress
+            if echo:
+                print(token, end='', flush=True)
 
-                # Accumulate the response
-                full_response += chunk_text
+            if message.get("done"):
+                break
 
-            # Now assume `full_response` has the final string, so let's process it
-            try:
-                # Split into individual JSON lines and extract the responses
-                json_lines = full_response.split("\n")  # Splitting by lines since we receive multiple JSON objects
-                response_parts = [json.loads(line).get("response", "") for line in json_lines if line.strip()]
-                
-                # Join all the parts of the response to get the final result
-                response_text = "".join(response_parts).strip()
-
-                # Remove any newlines from the final response text (if needed)
-                response_text = response_text.replace("\n", " ")  # Replace newlines with spaces
-
-                return response_text
-
-            except json.JSONDecodeError:
-                print("Failed to parse JSON. Full raw response:")
-                print(full_response)
-                return "Invalid JSON response received from LLM."
-
-    except requests.exceptions.RequestException as e:
-        print(f"Request failed: {e}")
-        return f"Request to LLM failed with error: {e}"
-
-# Function to check rows already processed in the output CSV
-def get_processed_rows(output_csv_file):
-    # If output file does not exist, assume no rows have been processed.
-    if not os.path.exists(output_csv_file):
-        return set()
-
-    processed_rows = set()
-    with open(output_csv_file, mode='r', encoding='utf-8') as file:
-        reader = csv.DictReader(file)
-        for row in reader:
-            processed_rows.add(row["pre_diagnosis"])  # Keep track of 'pre_diagnosis' in the output CSV
-    return processed_rows
-
-# Main function to handle row-wise diagnosis and output results directly to the CSV as we go
-def generate_llm_diagnosis(csv_input_file, csv_output_file):
-    # Step 1: Load the diagnostic information from the input CSV
-    df = pd.read_csv(csv_input_file)
-
-    # Step 2: Retrieve any rows that have already been processed
-    processed_rows = get_processed_rows(csv_output_file)
-
-    # Step 3: Loop over each row in the input CSV DataFrame
-    for index, row in df.iterrows():
-        pre_diagnosis_text = row.get("pre_diagnosis", "")  # Access the 'pre_diagnosis' column value
-
-        # Skip rows that are already in the output CSV (already processed)
-        if pre_diagnosis_text in processed_rows:
-            print(f"Row {index} already processed. Skipping.")
-            continue  # Skip previously processed rows
-
-        if not pre_diagnosis_text:
+            if deadline is not None and time.perf_counter() > deadline:
+                raise requests.exceptions.Timeout(f"No complete answer after {timeout}s")
+
+            # Count the numbered diagnoses once their line is complete
+            if not stop_early:
+                continue
+            if "\n" in token:
+                head, *completed = token.split("\n")
+                current_line.append(head)
+                for line in ["".join(current_line)] + completed[:-1]:
+                    if NUMBERED_LINE_PATTERN.match(line):
+                        numbered_lines += 1
+                current_line = [completed[-1]]
+                if numbered_lines >= 5:
+                    break
+            else:
+                current_line.append(token)
+
+        if echo:
+            print()
+
+        # Generation speed after the first token, every streamed message carries one token
+        token_count = sum(1 for part in response_parts if part)
+        metrics.inc('llm_tokens', token_count)
+        if first_token_time is not None and token_count > 1:
+            generation_time = time.perf_counter() - first_token_time
+            if generation_time > 0:
+                metrics.observe('llm_tokens_per_second', (token_count - 1) / generation_time)
+
+        # Join all the parts of the response to get the final result, the line breaks are kept
+        # since they tell list bullets apart from dashes inside a diagnosis
+        return "".join(response_parts).strip()
+
+# Main function to handle row-wise diagnosis and output results to a checkpoint journal as we go.
+# Up to `concurrency` requests are kept in flight, while all results are written by this thread only.
+# With a batch_tokens budget several cases are packed into each request (see query_llama_batch).
+# The journal (default: csv_output_file + '.journal') is synced every `sync_every` rows or `sync_interval`
+# seconds and rows already in it are skipped, it is written atomically to the output CSV at the end.
+# An output CSV without a journal (from an older run) is imported into a new journal first.
+# Returns the number of rows whose query failed, they are left out of the journal and the output.
+def generate_llm_diagnosis(csv_input_file, csv_output_file, concurrency=1, timeout=None, retries=0, backoff=1.0,
+                           cache=None, refresh_cache=False, echo=None, batch_tokens=0, journal_file=None,
+                           sync_every=100, sync_interval=5.0, resume=True):
+    # Step 1: Load the diagnostic information from the input file, only the column that is queried
+    df = read_frame(csv_input_file, columns=["pre_diagnosis"])
+
+    # Step 2: Open the journal of the rows that have already been processed
+    journal_file = journal_file or csv_output_file + '.journal'
+    if not resume:
+        CheckpointJournal.remove(journal_file)
+    journal_exists = os.path.exists(journal_file)
+    journal = CheckpointJournal(journal_file, sync_every=sync_every, sync_interval=sync_interval)
+    if journal.truncated_bytes:
+        print(f"Removed a partially written row ({journal.truncated_bytes} bytes) from the end of {journal_file}")
+    if not journal_exists and resume and os.path.exists(csv_output_file):
+        imported = journal.import_csv(csv_output_file)
+        print(f"Imported {imported} rows of {csv_output_file} into {journal_file}")
+        journal.close()
+        journal = CheckpointJournal(journal_file, sync_every=sync_every, sync_interval=sync_interval)
+
+    # Step 3: Collect the rows that still need a query, comparing the text keys with the journal at once
+    texts = df["pre_diagnosis"].tolist()
+    keys = make_row_keys(texts)
+    already_processed = journal.contains(keys)
+    pending = []
+    queued_keys = set()
+    skipped = 0
+    for index, pre_diagnosis_text, key, processed in zip(df.index, texts, keys.tolist(), already_processed.tolist()):
+        if not isinstance(pre_diagnosis_text, str) or not pre_diagnosis_text:
             print(f"Warning: No pre_diagnosis found for row {index}. Skipping.")
             continue  # Skip empty rows
 
-        # Query the LLM with the extracted 'pre_diagnosis' text
-        print(f"Querying LLM for row {index}...")
+        # Skip rows that are already in the journal (already processed), duplicated texts are only queried once
+        if processed or key in queued_keys:
+            skipped += 1
+            continue
 
-        # Streamed response will show in real-time
-        diagnosis_suggestions = query_llama(pre_diagnosis_text)
+        pending.append((index, pre_diagnosis_text, key))
+        queued_keys.add(key)
+    if skipped:
+        print(f"Skipping {skipped} rows already processed.")
 
-        # Step 4: Open the CSV file in append mode and write the result right after each query
-        with open(csv_output_file, mode='a', newline='', encoding='utf-8') as output_csv_file:
-            # Initialize CSV writer (setting quoting to QUOTE_ALL to handle any commas/newlines within fields)
-            writer = csv.DictWriter(output_csv_file, fieldnames=["pre_diagnosis", "llama_suggestions"], quoting=csv.QUOTE_ALL)
+    # By default only stream the tokens to the console when a single request is running
+    if echo is None:
+        echo = concurrency <= 1 and not batch_tokens
 
-            # If we're working with a fresh new file, write the header:
-            if not processed_rows:
-                writer.writeheader()
+    # Every request handles a batch of rows, a single row unless batching is enabled
+    if batch_tokens:
+        batches = make_batches(pending, batch_tokens)
+        print(f"Packed {len(pending)} rows into {len(batches)} batched requests.")
+    else:
+        batches = [[row] for row in pending]
+    # Size the keep-alive connection pool for the number of requests in flight
+    get_session(pool_size=concurrency)
+    start_time = time.time()
+    written = 0
+    failed = 0
 
-            # Write the new suggestion into the CSV file
-            writer.writerow({"pre_diagnosis": pre_diagnosis_text, "llama_suggestions": diagnosis_suggestions})
-            print(f"Row {index} processed. Written to output.")
+    # Step 4: Write each result to the journal as soon as it arrives, failed rows are left out of it
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            in_flight = {}
+            remaining_batches = iter(batches)
+            while True:
+                # Keep the pool filled up to the concurrency limit
+                while len(in_flight) < max(1, concurrency):
+                    batch = next(remaining_batches, None)
+                    if batch is None:
+                        break
+                    batch_texts = [pre_diagnosis_text for _, pre_diagnosis_text, _ in batch]
+                    # Query the LLM with the extracted 'pre_diagnosis' texts (a batch of one is a single-case query)
+                    print(f"Querying LLM for row{'s' if len(batch) > 1 else ''} "
+                          f"{', '.join(str(index) for index, _, _ in batch)}...")
+                    future = executor.submit(query_llama_batch, batch_texts, timeout, retries, backoff, echo, cache,
+                                             refresh_cache)
+                    in_flight[future] = batch
+
+                if not in_flight:
+                    break
 
-        # Recalculate processed rows after writing, so we track progress
-        processed_rows.add(pre_diagnosis_text)
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    batch = in_flight.pop(future)
+                    for (index, pre_diagnosis_text, key), diagnosis_suggestions in zip(batch, future.result()):
+                        if isinstance(diagnosis_suggestions, LlamaRequestError):
+                            failed += 1
+                            metrics.inc('rows_failed')
+                            print(f"Row {index} failed: {diagnosis_suggestions}")
+                            continue
+                        # Journal the new suggestion
+                        journal.append(key, pre_diagnosis_text, diagnosis_suggestions)
+                        written += 1
+                        metrics.inc('rows_processed')
+                        print(f"Row {index} processed. Written to output.")
+    finally:
+        # Also on errors or Ctrl+C, so the output CSV holds every row finished so far
+        journal.close()
+        rows = journal.finalize(csv_output_file)
 
     # Completion message
-    print(f"LLM diagnosis suggestions have been saved to {csv_output_file}")
+    elapsed = time.time() - start_time
+    if written:
+        print(f"Processed {written} rows in {elapsed:.1f}s ({written / elapsed * 60:.1f} rows/minute)")
+    if failed:
+        print(f"{failed} rows failed, they will be queried again on the next run")
+    if cache is not None:
+        stats = cache.stats()
+        print(f"Response cache: {stats['hits']} hits, {stats['misses']} misses, "
+              f"{stats['entries']} entries ({stats['bytes'] / 1024 / 1024:.1f} MB)")
+    print(f"LLM diagnosis suggestions for {rows} rows have been saved to {csv_output_file}")
+    return failed
 
-# Entry point for the script
-if __name__ == '__main__':
+# Entry point for the script, returns a non-zero exit code when some rows failed so that the
+# pipeline does not record the stage as done and runs it again
+def main(argv=None):
+    global OLLAMA_URL, MODEL
+    parser = argparse.ArgumentParser(description="Query the LLM for the top 5 diagnoses of every case.")
     # Input/Output CSV file paths
-    input_csv = "cases_diagnosis_cleaned_relevant.csv"  # This should be the source CSV with diagnoses
-    output_csv = "llama_answers.csv"     # New CSV that will contain Llama-generated suggestions
+    parser.add_argument("--input", default="cases_diagnosis_cleaned_relevant.csv",
+                        help="Source CSV, Parquet or Arrow file with the pre_diagnosis column")
+    parser.add_argument("--output", default="llama_answers.csv",
+                        help="CSV that will contain Llama-generated suggestions")
+    parser.add_argument("--url", default=None,
+                        help=f"Ollama instance URL (default: {OLLAMA_URL})")
+    parser.add_argument("--model", default=None,
+                        help=f"Model to query (default: {MODEL})")
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="Number of requests kept in flight at the same time")
+    parser.add_argument("--timeout", type=float, default=None,
+                        help="Seconds allowed per request, including the whole streamed answer")
+    parser.add_argument("--retries", type=int, default=0,
+                        help="Number of retries for a failed request")
+    parser.add_argument("--backoff", type=float, default=1.0,
+                        help="Initial retry delay in seconds, doubled after every attempt")
+    parser.add_argument("--cache-file", default="llama_cache.sqlite",
+                        help="SQLite file holding the persistent response cache")
+    parser.add_argument("--cache-max-mb", type=float, default=512,
+                        help="Size limit of the response cache, least recently used entries are evicted")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Bypass the response cache completely")
+    parser.add_argument("--refresh-cache", action="store_true",
+                        help="Query the LLM even for cached prompts and overwrite the cached answers")
+    parser.add_argument("--batch-tokens", type=int, default=0,
+                        help="Pack several cases into one JSON-formatted request up to this many prompt tokens "
+                             "(0 sends one case per request)")
+    parser.add_argument("--quiet", action="store_true",
+                        help="Do not print the streamed tokens to the console")
+    parser.add_argument("--journal", default=None,
+                        help="Checkpoint journal of the processed rows (default: OUTPUT.journal)")
+    parser.add_argument("--sync-every", type=int, default=100,
+                        help="Number of rows written to the journal between two fsyncs")
+    parser.add_argument("--sync-interval", type=float, default=5.0,
+                        help="Maximum number of seconds between two fsyncs of the journal")
+    parser.add_argument("--no-resume", action="store_true",
+                        help="Discard the journal and the rows already processed, and start over")
+    add_instrumentation_arguments(parser)
+    args = parser.parse_args(argv)
+
+    if args.url:
+        OLLAMA_URL = args.url
+    if args.model:
+        MODEL = args.model
+
+    cache = None
+    if not args.no_cache:
+        cache = ResponseCache(args.cache_file, max_bytes=int(args.cache_max_mb * 1024 * 1024))
+
     # Run the diagnosis generator with the specified CSV files
-    generate_llm_diagnosis(input_csv, output_csv)
\ No newline at end of file
+    with instrument_stage('query', args.metrics, args.profile, args.trace_memory):
+        failed = generate_llm_diagnosis(args.input, args.output, concurrency=args.concurrency, timeout=args.timeout,
+                                        retries=args.retries, backoff=args.backoff, cache=cache,
+                                        refresh_cache=args.refresh_cache, echo=False if args.quiet else None,
+                                        batch_tokens=args.batch_tokens, journal_file=args.journal,
+                                        sync_every=args.sync_every, sync_interval=args.sync_interval,
+                                        resume=not args.no_resume)
+
+    if cache is not None:
+        cache.close()
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,29 +1,77 @@
 import pandas as pd
-
-# Read CSV with proper quote character and delimiter
-df = pd.read_csv('cases.csv', quotechar='"', delimiter=',')
+import argparse  # For command line options
+from frame_io import FrameWriter, iter_frames  # For CSV, Parquet or Arrow input/output
+from metrics import metrics, add_instrumentation_arguments, instrument_stage  # For timers and counters
 
 def has_final_diagnosis(text):
     diagnosis_patterns = [
         'the final diagnosis was'
     ]
-    
+
     if isinstance(text, str):
         text_lower = text.lower()
         return any(pattern in text_lower for pattern in diagnosis_patterns)
     return False
 
-# Filter based on case_text column
-diagnosed = df[df['case_text'].apply(has_final_diagnosis)]
-undiagnosed = df[~df['case_text'].apply(has_final_diagnosis)]
+# Function to copy the cases that state a final diagnosis to the output file (CSV, Parquet or Arrow).
+# The input is read in chunks of `chunksize` rows and every chunk is appended to the output
+# right away, so memory stays flat regardless of the size of the input.
+# The other cases are written to `undiagnosed_file` when one is given.
+def filter_diagnosed_cases(input_file, output_file, chunksize=10000, undiagnosed_file=None):
+    diagnosed_count = 0
+    undiagnosed_count = 0
+    sample = []
+
+    undiagnosed_writer = FrameWriter(undiagnosed_file) if undiagnosed_file else None
+    try:
+        # Read CSV with proper quote character and delimiter
+        with FrameWriter(output_file) as writer:
+            for chunk in iter_frames(input_file, chunksize, quotechar='"', delimiter=','):
+                # Filter based on case_text column, evaluating the patterns once per row
+                mask = chunk['case_text'].apply(has_final_diagnosis).astype(bool)
+                diagnosed = chunk[mask]
+
+                # Save filtered datasets
+                writer.write(diagnosed)
+                if undiagnosed_writer is not None:
+                    undiagnosed_writer.write(chunk[~mask])
+
+                diagnosed_count += len(diagnosed)
+                metrics.inc('rows_processed', len(chunk))
+                metrics.inc('rows_kept', len(diagnosed))
+                undiagnosed_count += len(chunk) - len(diagnosed)
+                if len(sample) < 5:
+                    sample.extend(diagnosed['case_text'].head(5 - len(sample)))
+    finally:
+        if undiagnosed_writer is not None:
+            undiagnosed_writer.close()
+
+    return diagnosed_count, undiagnosed_count, sample
+
+# Command line entry point of the script
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Keep only the cases that state a final diagnosis.")
+    parser.add_argument("--input", default="cases.csv", help="CSV, Parquet or Arrow file with all the cases")
+    parser.add_argument("--output", default="cases_with_diagnosis.csv",
+                        help="CSV, Parquet or Arrow file that will contain the diagnosed cases")
+    parser.add_argument("--chunksize", type=int, default=10000,
+                        help="Number of rows read and written at a time")
+    parser.add_argument("--undiagnosed-output", default=None,
+                        help="CSV, Parquet or Arrow file that will contain the cases without a final diagnosis")
+    add_instrumentation_arguments(parser)
+    args = parser.parse_args(argv)
+
+    with instrument_stage('separate', args.metrics, args.profile, args.trace_memory):
+        diagnosed_count, undiagnosed_count, sample = filter_diagnosed_cases(args.input, args.output,
+                                                                            chunksize=args.chunksize,
+                                                                            undiagnosed_file=args.undiagnosed_output)
 
-# Save filtered datasets
-diagnosed.to_csv('cases_with_diagnosis.csv', index=False)
-#undiagnosed.to_csv('cases_without_diagnosis.csv', index=False)
+    print(f"Cases with diagnosis: {diagnosed_count}")
+    print(f"Cases without diagnosis: {undiagnosed_count}")
 
-print(f"Cases with diagnosis: {len(diagnosed)}")
-#print(f"Cases without diagnosis: {len(undiagnosed)}")
+    # Display first few rows of diagnosed cases to verify
+    print("\nSample of diagnosed cases:")
+    print(pd.Series(sample, name='case_text'))
 
-# Display first few rows of diagnosed cases to verify
-print("\nSample of diagnosed cases:")
-print(diagnosed['case_text'].head())
\ No newline at end of file
+if __name__ == '__main__':
+    main()
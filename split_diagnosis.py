@@ -1,10 +1,31 @@
 import re
+import argparse  # For command line options
 import pandas as pd
+from frame_io import FrameWriter, iter_frames  # For CSV, Parquet or Arrow input/output
+from metrics import metrics, add_instrumentation_arguments, instrument_stage  # For timers and counters
 
 # Define the file paths for the input and output files
 input_file = 'cases_with_diagnosis.csv'
 output_file = 'cases_with_separated_diagnosis_truncated.csv'
 
+# Default keywords signaling the diagnosis portion of text
+DEFAULT_DIAGNOSIS_KEYWORDS = [
+    r'the final diagnosis was'
+]
+
+# Case texts longer than this are discarded
+MAX_CASE_TEXT_LENGTH = 3000
+
+# Text used when no diagnosis keyword is found in the case text
+DIAGNOSIS_NOT_STATED = "Diagnosis not explicitly stated"
+
+# Function to combine keywords into a regex pattern to detect them in text
+def compile_diagnosis_pattern(diagnosis_keywords):
+    return re.compile('|'.join(diagnosis_keywords), re.IGNORECASE)
+
+# The default pattern is compiled once instead of for every case
+DEFAULT_DIAGNOSIS_PATTERN = compile_diagnosis_pattern(DEFAULT_DIAGNOSIS_KEYWORDS)
+
 def separate_diagnosis(case_text, diagnosis_keywords=None):
     """
     Separates the 'pre-diagnosis' description from the 'diagnosis' itself using heuristic rules.
@@ -17,21 +38,18 @@ def separate_diagnosis(case_text, diagnosis_keywords=None):
     - pre_diagnosis_text: Text that describes symptoms, medical reports but NOT the final diagnosis.
     - diagnosis_text: Text that specifies the final diagnosis.
     """
-    # Default keywords signaling the diagnosis portion of text
+    # Use the precompiled pattern unless specific keywords are given
     if diagnosis_keywords is None:
-        diagnosis_keywords = [
-            r'the final diagnosis was'
-        ]
-    
-    # Combine keywords into a regex pattern to detect them in text
-    diagnosis_pattern = re.compile('|'.join(diagnosis_keywords), re.IGNORECASE)
+        diagnosis_pattern = DEFAULT_DIAGNOSIS_PATTERN
+    else:
+        diagnosis_pattern = compile_diagnosis_pattern(diagnosis_keywords)
     
     # Split case_text based on matched diagnostic keywords
     split_sections = diagnosis_pattern.split(case_text, maxsplit=1)
     
     # Define pre-diagnosis and diagnosis section based on splitting
     pre_diagnosis_text = split_sections[0].strip()
-    diagnosis_text = split_sections[1].strip() if len(split_sections) > 1 else "Diagnosis not explicitly stated"
+    diagnosis_text = split_sections[1].strip() if len(split_sections) > 1 else DIAGNOSIS_NOT_STATED
     
     return pre_diagnosis_text, diagnosis_text
 
@@ -54,55 +72,89 @@ def truncate_diagnosis(diagnosis_text):
         # No period found, return the full diagnosis text
         return diagnosis_text.strip()
 
-def process_cases_in_csv(input_file, output_file):
+def split_cases(df, diagnosis_pattern=DEFAULT_DIAGNOSIS_PATTERN):
     """
-    Reads the input CSV file, processes each case to separate the pre-diagnosis from the diagnosis,
-    truncates the diagnosis after the first dot, and then writes the results to a new CSV file.
-    Discards any cases where the diagnosis has over 1000 characters.
+    Vectorized version of separate_diagnosis and truncate_diagnosis over a whole DataFrame.
+    Drops the cases whose text is longer than MAX_CASE_TEXT_LENGTH characters and adds the
+    'pre_diagnosis' and 'diagnosis' columns to the remaining rows, keeping their original index.
     
     Parameters:
-    - input_file: The path to the input CSV file.
-    - output_file: The path to the output CSV file.
-    """
-    # Load the CSV into a DataFrame
-    df = pd.read_csv(input_file)
-    
-    # Verify that required columns exist in the CSV
-    if 'case_id' not in df.columns or 'gender' not in df.columns or 'age' not in df.columns or 'case_text' not in df.columns:
-        print("Error: The input CSV file must contain the columns: 'case_id', 'gender', 'age', 'case_text'.")
-        return
-    
-    # Lists to store separated and filtered data
-    pre_diagnosis_list = []
-    diagnosis_list = []
+    - df: DataFrame with a 'case_text' column.
+    - diagnosis_pattern: Compiled regex signaling the diagnosis portion of text.
     
-    # Loop over each case in the dataframe
-    for _, row in df.iterrows():
-        case_text = row['case_text']
-        
-        # Check if the case_text length is within 1000 characters
-        if len(case_text) > 3000:
-            print(f"Skipping case {row['case_id']} - Diagnosis longer than 1000 characters.")
-            continue  # Skip current row if diagnosis is more than 1000 characters
-
-        # Separate the pre-diagnosis from diagnosis in the case text
-        pre_diagnosis, diagnosis = separate_diagnosis(case_text)
-        
-        # Truncate the diagnosis at the first dot.
-        truncated_diagnosis = truncate_diagnosis(diagnosis)
-        
-        # Append the results to lists
-        pre_diagnosis_list.append(pre_diagnosis)
-        diagnosis_list.append(truncated_diagnosis)
-    
-    # Update the DataFrame with the new columns
-    df = df.loc[0:len(pre_diagnosis_list)-1]  # Select rows matching filtered cases
-    df['pre_diagnosis'] = pre_diagnosis_list
-    df['diagnosis'] = diagnosis_list
+    Returns:
+    - split_df: The kept rows with the new columns.
+    - skipped_count: The number of discarded cases.
+    """
+    # Keep only the cases within the length limit, the index is preserved so rows stay paired
+    keep = df['case_text'].str.len() <= MAX_CASE_TEXT_LENGTH
+    split_df = df[keep].copy()
+    if split_df.empty:
+        return split_df.assign(pre_diagnosis=pd.Series(dtype=object), diagnosis=pd.Series(dtype=object)), int((~keep).sum())
+
+    # Split case_text once on the first matched diagnostic keyword
+    sections = split_df['case_text'].str.split(diagnosis_pattern, n=1, regex=True, expand=True)
+    pre_diagnosis = sections[0].str.strip()
+    if 1 in sections.columns:
+        diagnosis = sections[1].str.strip().fillna(DIAGNOSIS_NOT_STATED)
+    else:
+        diagnosis = pd.Series(DIAGNOSIS_NOT_STATED, index=split_df.index)
+
+    # Truncate the diagnosis at the first dot, keeping the dot, or keep it whole without a dot
+    first_sentence = diagnosis.str.extract(r'^([^.]*\.)', expand=False)
+    diagnosis = first_sentence.fillna(diagnosis).str.strip()
+
+    split_df['pre_diagnosis'] = pre_diagnosis
+    split_df['diagnosis'] = diagnosis
+    return split_df, int((~keep).sum())
+
+def process_cases_in_csv(input_file, output_file, chunksize=10000):
+    """
+    Reads the input file, processes each case to separate the pre-diagnosis from the diagnosis,
+    truncates the diagnosis after the first dot, and then writes the results to a new file.
+    Both files can be CSV, Parquet or Arrow, depending on their extension.
+    Discards any cases where the case text has over 3000 characters.
+    The input is read in chunks of `chunksize` rows and each processed chunk is appended to the
+    output right away, so memory stays flat regardless of the size of the input.
     
-    # Save the modified DataFrame to a new CSV file, without discarded rows
-    df.to_csv(output_file, index=False)
+    Parameters:
+    - input_file: The path to the input file.
+    - output_file: The path to the output file.
+    - chunksize: The number of rows read and written at a time.
+    """
+    # Load the input in chunks
+    with FrameWriter(output_file) as writer:
+        for df in iter_frames(input_file, chunksize):
+            # Verify that required columns exist in the CSV
+            if 'case_id' not in df.columns or 'gender' not in df.columns or 'age' not in df.columns or 'case_text' not in df.columns:
+                print("Error: The input CSV file must contain the columns: 'case_id', 'gender', 'age', 'case_text'.")
+                return
+
+            # Separate and truncate the diagnosis of the whole chunk at once
+            df, skipped_count = split_cases(df)
+            metrics.inc('rows_processed', len(df))
+            metrics.inc('rows_skipped', skipped_count)
+            if skipped_count:
+                print(f"Skipping {skipped_count} cases - Case text longer than {MAX_CASE_TEXT_LENGTH} characters.")
+
+            # Append the modified chunk to the output file, without discarded rows
+            writer.write(df)
+
     print(f"Processed data has been saved to {output_file}")
 
-# Run the processing function
-process_cases_in_csv(input_file, output_file)
\ No newline at end of file
+# Command line entry point of the script
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Separate the pre-diagnosis text from the final diagnosis.")
+    parser.add_argument("--input", default=input_file, help="CSV, Parquet or Arrow file with the diagnosed cases")
+    parser.add_argument("--output", default=output_file, help="CSV, Parquet or Arrow file that will contain the separated diagnosis")
+    parser.add_argument("--chunksize", type=int, default=10000,
+                        help="Number of rows read and written at a time")
+    add_instrumentation_arguments(parser)
+    args = parser.parse_args(argv)
+
+    # Run the processing function
+    with instrument_stage('split', args.metrics, args.profile, args.trace_memory):
+        process_cases_in_csv(args.input, args.output, chunksize=args.chunksize)
+
+if __name__ == '__main__':
+    main()
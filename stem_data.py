@@ -1,49 +1,50 @@
-import pandas as pd
-import re
-import nltk
-from nltk.corpus import stopwords
-from nltk.stem import PorterStemmer
+import argparse  # For command line options
+from text_normalizer import TextNormalizer
+from frame_io import read_frame, write_frame  # For CSV, Parquet or Arrow input/output
+from metrics import metrics, add_instrumentation_arguments, instrument_stage  # For timers and counters
 
-# Download necessary NLTK resources (if not already downloaded)
-nltk.download('punkt')
-nltk.download('stopwords')
-
-# Initialize the Porter Stemmer and the stop words for filtering out irrelevant words
-ps = PorterStemmer()
-stop_words = set(stopwords.words('english'))
-
-# Load the original CSV file
-input_csv_file = 'cases_with_separated_diagnosis_truncated.csv'
-df = pd.read_csv(input_csv_file)
+# Shared normalizer (lowercase, strip, tokenize, remove stop words, stem)
+normalizer = TextNormalizer()
 
 # Function to clean the diagnosis column and remove irrelevant terms
 def extract_relevant_terms(diagnosis_text):
-    # Convert text to lowercase for uniformity
-    diagnosis_text = diagnosis_text.lower()
-    
-    # Remove any special characters other than alphabetic ones, to retain diagnostic info
-    diagnosis_text = re.sub(r'[^a-z\s]', '', diagnosis_text)
-    
-    # Tokenize the diagnosis text into words
-    word_tokens = nltk.word_tokenize(diagnosis_text)
-    
-    # Filter out irrelevant words (e.g., stop words like 'the', 'and', etc.)
-    filtered_words = [word for word in word_tokens if word not in stop_words]
-    
-    # Stem each word in the filtered diagnosis
-    stemmed_words = [ps.stem(word) for word in filtered_words]
-    
     # Join the stemmed words back into a cleaned diagnosis string
-    cleaned_diagnosis = ' '.join(stemmed_words)
-    
-    return cleaned_diagnosis
+    return ' '.join(normalizer.terms(diagnosis_text))
+
+# Function to replace the "diagnosis" column of the input file with its relevant terms.
+# The input and output can be CSV, Parquet or Arrow files, depending on their extension.
+# workers=None normalizes on all cores, small inputs always run serially.
+def stem_diagnoses(input_file, output_file, workers=None):
+    # Load the original file
+    df = read_frame(input_file)
+
+    # Normalize the "diagnosis" column in one batch, replacing it with the relevant terms
+    with metrics.timer('normalize_seconds'):
+        df['diagnosis'] = normalizer.normalize_series(df['diagnosis'], workers=workers).map(' '.join)
+    metrics.inc('rows_processed', len(df))
+
+    # Save the updated DataFrame to a new file, ensuring we maintain proper CSV format for CSV output
+    write_frame(df, output_file)
+    return df
+
+# Command line entry point of the script
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Clean and stem the diagnosis column of the cases.")
+    parser.add_argument("--input", default="cases_with_separated_diagnosis_truncated.csv",
+                        help="CSV, Parquet or Arrow file with the separated and truncated diagnosis")
+    parser.add_argument("--output", default="cases_diagnosis_cleaned_relevant.csv",
+                        help="CSV, Parquet or Arrow file that will contain the cleaned diagnosis")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of worker processes (default: all cores, 1 disables the pool)")
+    add_instrumentation_arguments(parser)
+    args = parser.parse_args(argv)
 
-# Apply the extraction function to the "diagnosis" column, replacing it with the relevant terms
-df['diagnosis'] = df['diagnosis'].apply(extract_relevant_terms)
+    with instrument_stage('stem', args.metrics, args.profile, args.trace_memory):
+        df = stem_diagnoses(args.input, args.output, workers=args.workers)
 
-# Save the updated DataFrame back to a new CSV file, ensuring we maintain proper CSV format
-output_csv_file = 'cases_diagnosis_cleaned_relevant.csv'
-df.to_csv(output_csv_file, index=False)
+    # Optionally print the first few rows for inspection
+    print(df.head())
 
-# Optionally print the first few rows for inspection
-print(df.head())
\ No newline at end of file
+# The process pool re-imports this module in its workers, so the script only runs under __main__
+if __name__ == '__main__':
+    main()
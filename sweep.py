@@ -0,0 +1,308 @@
+import argparse  # For command line options
+import csv  # For the table of configurations
+import itertools  # For the grid of configurations
+import os  # For the output directories
+import re  # For turning configurations into directory names
+import time  # For throughput reporting
+from collections import deque  # For the queue of jobs of every model
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED  # For keeping several requests in flight
+import pandas as pd
+import run_llama
+from llm_cache import ResponseCache  # For reusing answers of already queried prompts
+from checkpoint import CheckpointJournal, make_row_keys  # For crash-safe resumable output per configuration
+from frame_io import read_frame  # For CSV, Parquet or Arrow input
+from metrics import metrics, add_instrumentation_arguments, instrument_stage  # For timers and counters
+
+# Name of the prompt of run_llama, used when no --prompts are given
+DEFAULT_PROMPT = 'default'
+
+# Characters allowed in the directory name of a configuration, anything else becomes '-'
+UNSAFE_TAG_PATTERN = re.compile(r'[^A-Za-z0-9._-]+')
+
+class SweepConfig:
+    """
+    One point of the sweep grid: a model, a named prompt template and a temperature.
+    Its answers and scores are written under `<output_dir>/<tag>/`.
+    """
+
+    def __init__(self, model, prompt_name, prompt_template, temperature):
+        self.model = model
+        self.prompt_name = prompt_name
+        self.prompt_template = prompt_template
+        self.temperature = temperature
+        self.tag = UNSAFE_TAG_PATTERN.sub('-', f"{model}_{prompt_name}_t{temperature:g}")
+
+    def paths(self, output_dir):
+        config_dir = os.path.join(output_dir, self.tag)
+        return {'dir': config_dir, 'answers': os.path.join(config_dir, 'llama_answers.csv'),
+                'scores': os.path.join(config_dir, 'scores.csv')}
+
+# Function to load the prompt templates given as NAME=FILE ('default' alone is the prompt of run_llama)
+def load_prompt_templates(specs):
+    templates = {}
+    for spec in specs or [DEFAULT_PROMPT]:
+        name, _, path = spec.partition('=')
+        if name in templates:
+            raise ValueError(f"Prompt '{name}' is given more than once")
+        if not path:
+            if name != DEFAULT_PROMPT:
+                raise ValueError(f"Prompt '{spec}' must be given as NAME=FILE")
+            templates[name] = run_llama.PROMPT_TEMPLATE
+            continue
+        with open(path, 'r', encoding='utf-8') as file:
+            template = file.read()
+        if '{pre_diagnosis_text}' not in template:
+            raise ValueError(f"Prompt file {path} has no {{pre_diagnosis_text}} placeholder")
+        templates[name] = template
+    return templates
+
+# Function to parse the per-model concurrency limits given as MODEL=N
+def parse_model_limits(specs):
+    limits = {}
+    for spec in specs:
+        model, _, limit = spec.rpartition('=')
+        if not model or not limit.isdigit() or int(limit) < 1:
+            raise ValueError(f"Model concurrency '{spec}' must be given as MODEL=N with N >= 1")
+        limits[model] = int(limit)
+    return limits
+
+# Function to build every (model, prompt, temperature) combination of the grid. Repeated models and
+# temperatures are only used once, and configurations whose tags (their directory) would still be the
+# same, e.g. models only differing in characters replaced in the tag, are rejected with a ValueError.
+def build_grid(models, prompt_templates, temperatures):
+    models = list(dict.fromkeys(models))
+    temperatures = list(dict.fromkeys(float(temperature) for temperature in temperatures))
+    configs = [SweepConfig(model, prompt_name, prompt_templates[prompt_name], temperature)
+               for model, prompt_name, temperature in itertools.product(models, prompt_templates, temperatures)]
+
+    configs_by_tag = {}
+    for config in configs:
+        configs_by_tag.setdefault(config.tag, []).append(config)
+    collisions = []
+    for tag, same_tag in configs_by_tag.items():
+        if len(same_tag) > 1:
+            names = ', '.join(f"({config.model}, {config.prompt_name}, {config.temperature:g})" for config in same_tag)
+            collisions.append(f"{names} -> {tag}")
+    if collisions:
+        raise ValueError(f"Several configurations would share the same output directory: {'; '.join(collisions)}")
+    return configs
+
+# Function to open the journal of every configuration and queue the (case, config) jobs that are not in it yet.
+# The jobs of a model alternate between its configurations case by case, so that all of them progress
+# together and an interrupted sweep can still be compared on the cases finished so far.
+def schedule_jobs(configs, texts, output_dir, sync_every, sync_interval, resume):
+    keys = make_row_keys(texts)
+    journals = {}
+    done_by_config = {}
+    for config in configs:
+        paths = config.paths(output_dir)
+        os.makedirs(paths['dir'], exist_ok=True)
+        journal_file = paths['answers'] + '.journal'
+        if not resume:
+            CheckpointJournal.remove(journal_file)
+        journals[config.tag] = CheckpointJournal(journal_file, sync_every=sync_every, sync_interval=sync_interval)
+        if journals[config.tag].truncated_bytes:
+            print(f"Removed a partially written row ({journals[config.tag].truncated_bytes} bytes) "
+                  f"from the end of {journal_file}")
+        done_by_config[config.tag] = journals[config.tag].contains(keys).tolist()
+
+    queues = {}
+    for position, (text, key) in enumerate(zip(texts, keys.tolist())):
+        for config in configs:
+            if not done_by_config[config.tag][position]:
+                queues.setdefault(config.model, deque()).append((config, text, key))
+    return journals, queues
+
+# Function to run all the queued jobs through one shared thread pool, keeping at most limits[model]
+# requests in flight per model, so a slow model never holds back the others.
+# Every answer is written to the journal of its configuration as soon as it arrives, failed jobs
+# are left out of it so that they are queried again on the next run.
+def run_jobs(queues, journals, limits, default_limit, timeout=None, retries=0, backoff=1.0, cache=None,
+             refresh_cache=False):
+    model_limits = {model: limits.get(model, default_limit) for model in queues}
+    total_jobs = sum(len(queue) for queue in queues.values())
+    # Size the keep-alive connection pool for the number of requests in flight
+    run_llama.get_session(pool_size=max(1, sum(model_limits.values())))
+    start_time = time.time()
+    written = 0
+    failed = 0
+
+    with ThreadPoolExecutor(max_workers=max(1, sum(model_limits.values()))) as executor:
+        in_flight = {}
+        running = {model: 0 for model in queues}
+        while True:
+            # Top up every model to its own limit
+            for model, queue in queues.items():
+                while queue and running[model] < model_limits[model]:
+                    config, text, key = queue.popleft()
+                    future = executor.submit(run_llama.query_llama, text, timeout, retries, backoff, False, cache,
+                                             refresh_cache, config.model, config.prompt_template,
+                                             config.temperature)
+                    in_flight[future] = (config, text, key)
+                    running[model] += 1
+            metrics.set('sweep_in_flight', len(in_flight))
+
+            if not in_flight:
+                break
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                config, text, key = in_flight.pop(future)
+                running[config.model] -= 1
+                try:
+                    journals[config.tag].append(key, text, future.result())
+                    written += 1
+                    metrics.inc('rows_processed')
+                except run_llama.LlamaRequestError as e:
+                    failed += 1
+                    metrics.inc('rows_failed')
+                    print(f"Job of {config.tag} failed: {e}")
+                if (written + failed) % 100 == 0 or written + failed == total_jobs:
+                    elapsed = time.time() - start_time
+                    print(f"{written + failed}/{total_jobs} jobs done "
+                          f"({(written + failed) / elapsed * 60:.1f} jobs/minute, {failed} failed)")
+    if failed:
+        print(f"{failed} jobs failed, they will be queried again on the next run")
+    return written
+
+# Function to score the answers of every configuration and return the side-by-side summary
+def compare_configs(configs, output_dir, cases_file, n_boot=1000, alpha=0.05):
+    # Imported here so that the sweep can query the LLM without the NLTK data installed
+    import extract_results
+    import print_final_statistics
+
+    summaries = []
+    for config in configs:
+        paths = config.paths(output_dir)
+        print(f"\nScoring {config.tag}...")
+        scores_df = extract_results.score_answers(paths['answers'], cases_file, paths['scores'])
+        summary = {'model': config.model, 'prompt': config.prompt_name, 'temperature': config.temperature}
+        summary.update(print_final_statistics.summarize(print_final_statistics.match_matrix(scores_df),
+                                                        n_boot=n_boot, alpha=alpha))
+        summaries.append(summary)
+    return pd.DataFrame(summaries).set_index(['model', 'prompt', 'temperature'])
+
+# Function to write the table of the configurations and where their results are
+def write_config_table(configs, output_dir):
+    with open(os.path.join(output_dir, 'configs.csv'), mode='w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerow(['tag', 'model', 'prompt', 'temperature', 'answers', 'scores'])
+        for config in configs:
+            paths = config.paths(output_dir)
+            writer.writerow([config.tag, config.model, config.prompt_name, config.temperature,
+                             paths['answers'], paths['scores']])
+
+# Function to run the whole sweep: query every (case, config) job, write the answers of every
+# configuration and, unless score is False, score them and write the comparison table
+def run_sweep(configs, cases_file, output_dir, limits=None, default_limit=1, limit_cases=None, timeout=None,
+              retries=0, backoff=1.0, cache=None, refresh_cache=False, sync_every=100, sync_interval=5.0,
+              resume=True, score=True, n_boot=1000, alpha=0.05):
+    # Step 1: Load the distinct case texts, each one is queried once per configuration
+    df = read_frame(cases_file, columns=['pre_diagnosis'])
+    texts = [text for text in pd.unique(df['pre_diagnosis']) if isinstance(text, str) and text]
+    if limit_cases:
+        texts = texts[:limit_cases]
+    os.makedirs(output_dir, exist_ok=True)
+    write_config_table(configs, output_dir)
+
+    # Step 2: Queue the jobs missing from the journals of the configurations
+    journals, queues = schedule_jobs(configs, texts, output_dir, sync_every, sync_interval, resume)
+    pending = sum(len(queue) for queue in queues.values())
+    print(f"{len(configs)} configurations x {len(texts)} cases: {pending} jobs to run, "
+          f"{len(configs) * len(texts) - pending} already done.")
+
+    # Step 3: Run them through the shared scheduler, the answer CSVs are written also on errors or Ctrl+C
+    try:
+        run_jobs(queues, journals, limits or {}, default_limit, timeout=timeout, retries=retries, backoff=backoff,
+                 cache=cache, refresh_cache=refresh_cache)
+    finally:
+        for config in configs:
+            journals[config.tag].close()
+            journals[config.tag].finalize(config.paths(output_dir)['answers'])
+
+    if not score:
+        return None
+
+    # Step 4: Score every configuration and compare them side by side
+    comparison = compare_configs(configs, output_dir, cases_file, n_boot=n_boot, alpha=alpha)
+    comparison.to_csv(os.path.join(output_dir, 'comparison.csv'))
+    return comparison
+
+# Command line entry point of the script
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Query every case with a grid of models, prompts and "
+                                                 "temperatures and compare their scores.")
+    parser.add_argument("--cases", default="cases_diagnosis_cleaned_relevant.csv",
+                        help="CSV, Parquet or Arrow file with the pre_diagnosis, case_id and diagnosis columns")
+    parser.add_argument("--output-dir", default="sweep_results",
+                        help="Directory receiving one sub-directory of answers and scores per configuration")
+    parser.add_argument("--url", default=None,
+                        help=f"Ollama instance URL (default: {run_llama.OLLAMA_URL})")
+    parser.add_argument("--models", nargs='+', default=[run_llama.MODEL], help="Models to query")
+    parser.add_argument("--prompts", nargs='+', default=None, metavar='NAME=FILE',
+                        help="Prompt templates containing {pre_diagnosis_text}, "
+                             f"'{DEFAULT_PROMPT}' is the prompt of run_llama (default: {DEFAULT_PROMPT})")
+    parser.add_argument("--temperatures", nargs='+', type=float, default=[0.7], help="Temperatures to query with")
+    parser.add_argument("--concurrency", type=int, default=2,
+                        help="Number of requests kept in flight per model")
+    parser.add_argument("--model-concurrency", nargs='*', default=[], metavar='MODEL=N',
+                        help="Per-model overrides of --concurrency")
+    parser.add_argument("--limit", type=int, default=None, help="Only query the first LIMIT distinct cases")
+    parser.add_argument("--timeout", type=float, default=None,
+                        help="Seconds allowed per request, including the whole streamed answer")
+    parser.add_argument("--retries", type=int, default=0, help="Number of retries for a failed request")
+    parser.add_argument("--backoff", type=float, default=1.0,
+                        help="Initial retry delay in seconds, doubled after every attempt")
+    parser.add_argument("--cache-file", default="llama_cache.sqlite",
+                        help="SQLite file holding the persistent response cache")
+    parser.add_argument("--cache-max-mb", type=float, default=512,
+                        help="Size limit of the response cache, least recently used entries are evicted")
+    parser.add_argument("--no-cache", action="store_true", help="Bypass the response cache completely")
+    parser.add_argument("--refresh-cache", action="store_true",
+                        help="Query the LLM even for cached prompts and overwrite the cached answers")
+    parser.add_argument("--sync-every", type=int, default=100,
+                        help="Number of rows written to a journal between two fsyncs")
+    parser.add_argument("--sync-interval", type=float, default=5.0,
+                        help="Maximum number of seconds between two fsyncs of a journal")
+    parser.add_argument("--no-resume", action="store_true",
+                        help="Discard the answers of an earlier sweep in the output directory and start over")
+    parser.add_argument("--no-score", action="store_true", help="Only query the LLM, do not score the answers")
+    parser.add_argument("--bootstrap", type=int, default=1000,
+                        help="Number of bootstrap resamples for the confidence intervals (0 disables them)")
+    parser.add_argument("--alpha", type=float, default=0.05,
+                        help="Significance level of the confidence intervals")
+    add_instrumentation_arguments(parser)
+    args = parser.parse_args(argv)
+
+    try:
+        prompt_templates = load_prompt_templates(args.prompts)
+        limits = parse_model_limits(args.model_concurrency)
+        configs = build_grid(args.models, prompt_templates, args.temperatures)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    if args.url:
+        run_llama.OLLAMA_URL = args.url
+
+    cache = None
+    if not args.no_cache:
+        cache = ResponseCache(args.cache_file, max_bytes=int(args.cache_max_mb * 1024 * 1024))
+
+    with instrument_stage('sweep', args.metrics, args.profile, args.trace_memory):
+        comparison = run_sweep(configs, args.cases, args.output_dir, limits=limits, default_limit=args.concurrency,
+                               limit_cases=args.limit, timeout=args.timeout, retries=args.retries,
+                               backoff=args.backoff, cache=cache, refresh_cache=args.refresh_cache,
+                               sync_every=args.sync_every, sync_interval=args.sync_interval,
+                               resume=not args.no_resume, score=not args.no_score, n_boot=args.bootstrap,
+                               alpha=args.alpha)
+
+    if cache is not None:
+        cache.close()
+
+    if comparison is not None:
+        print("\nComparison:")
+        print(comparison.round(2).to_string())
+        print(f"\nConfigurations, answers and scores are listed in {os.path.join(args.output_dir, 'configs.csv')}, "
+              f"the comparison is saved to {os.path.join(args.output_dir, 'comparison.csv')}")
+
+if __name__ == '__main__':
+    main()
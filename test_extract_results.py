@@ -0,0 +1,52 @@
+from extract_results import AbbreviationExpander, parse_suggestions
+
+
+def test_expands_whole_words_only():
+    expander = AbbreviationExpander({'leprosy': ['lep'], 'chronic osteomyelitis': ['co']})
+    assert expander.expand('lep and leprosy in a cohort') == 'leprosy and leprosy in a cohort'
+    assert expander.expand('co') == 'chronic osteomyelitis'
+
+
+def test_expands_multi_word_abbreviations_across_spaces_and_hyphens():
+    expander = AbbreviationExpander({'multibacillary leprosy': ['mb leprosy']})
+    assert expander.expand('mb  leprosy, mb-leprosy') == 'multibacillary leprosy, multibacillary leprosy'
+
+
+def test_expands_hyphenated_abbreviations():
+    expander = AbbreviationExpander({'radiograph': ['x-ray'], 'non hodgkin lymphoma': ['Non-Hodgkin']})
+    assert expander.expand('a x-ray here') == 'a radiograph here'
+    assert expander.expand('an x ray') == 'an radiograph'
+    assert expander.expand('non-hodgkin') == 'non hodgkin lymphoma'
+
+
+def test_parses_a_numbered_list_and_keeps_numbers_inside_items():
+    assert parse_suggestions("1. Type 2 diabetes 2. Stage 1: cancer 3) Gout") == \
+        (['Type 2 diabetes', 'Stage 1: cancer', 'Gout'], 'numbered')
+
+
+def test_numbered_list_wins_over_a_dash_in_the_preamble():
+    text = "Here are the top 5 - brief list: 1. Sarcoidosis 2. Tuberculosis 3. Lymphoma 4. Gout 5. Lupus"
+    assert parse_suggestions(text) == (['Sarcoidosis', 'Tuberculosis', 'Lymphoma', 'Gout', 'Lupus'], 'numbered')
+
+
+def test_numbered_list_wins_over_bullets_before_it():
+    assert parse_suggestions("Notes:\n- short\n- answers\n1. Gout\n2. Lupus") == (['Gout', 'Lupus'], 'numbered')
+
+
+def test_dashes_inside_bulleted_items_do_not_split_them():
+    assert parse_suggestions("- Lymphoma - B cell\n- Tuberculosis\n  - Gout") == \
+        (['Lymphoma - B cell', 'Tuberculosis', 'Gout'], 'bulleted')
+    assert parse_suggestions("- Lymphoma - B cell - Tuberculosis") == (['Lymphoma - B cell - Tuberculosis'], 'bulleted')
+    assert parse_suggestions("* Lymphoma - B cell * Tuberculosis") == (['Lymphoma - B cell', 'Tuberculosis'], 'bulleted')
+
+
+def test_parses_json_answers_and_truncates_long_lists():
+    assert parse_suggestions('{"diagnoses": ["Gout", "Lupus"]}') == (['Gout', 'Lupus'], 'json')
+    assert parse_suggestions("1. Gout 2. Lupus 3. Sarcoidosis 4. Lymphoma 5. Tuberculosis 6. Extra")[0][-1] == \
+        'Tuberculosis'
+
+
+def test_answers_without_a_list_fail():
+    assert parse_suggestions("I cannot answer that.") == ([], 'failed')
+    assert parse_suggestions("2. Gout 3. Lupus") == ([], 'failed')
+    assert parse_suggestions(None) == ([], 'failed')
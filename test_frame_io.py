@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+import pytest
+from frame_io import FrameWriter, read_frame
+
+pytest.importorskip('pyarrow')
+
+
+@pytest.mark.parametrize('extension', ['.parquet', '.arrow'])
+def test_column_empty_in_the_first_chunk_gets_the_type_of_later_chunks(tmp_path, extension):
+    path = str(tmp_path / f'cases{extension}')
+    with FrameWriter(path) as writer:
+        writer.write(pd.DataFrame({'case_id': [1, 2], 'gender': [np.nan, np.nan], 'age': [40.0, 41.0]}))
+        writer.write(pd.DataFrame({'case_id': [3, 4], 'gender': ['F', 'M'], 'age': [42.0, np.nan]}))
+
+    df = read_frame(path)
+    assert df['case_id'].tolist() == [1, 2, 3, 4]
+    assert df['gender'].tolist()[2:] == ['F', 'M']
+    assert df['gender'].isna().tolist() == [True, True, False, False]
+    assert df['age'].isna().tolist() == [False, False, False, True]
+
+
+@pytest.mark.parametrize('extension', ['.parquet', '.arrow'])
+def test_column_without_any_value_is_written_as_strings(tmp_path, extension):
+    path = str(tmp_path / f'cases{extension}')
+    with FrameWriter(path, max_buffered_rows=2) as writer:
+        writer.write(pd.DataFrame({'case_id': [1, 2], 'gender': [np.nan, np.nan]}))
+        writer.write(pd.DataFrame({'case_id': [3], 'gender': [np.nan]}))
+
+    df = read_frame(path)
+    assert df['case_id'].tolist() == [1, 2, 3]
+    assert df['gender'].isna().all()
+
+
+@pytest.mark.parametrize('extension', ['.parquet', '.arrow'])
+def test_integer_column_is_widened_for_fractional_values_in_later_chunks(tmp_path, extension):
+    path = str(tmp_path / f'cases{extension}')
+    with FrameWriter(path) as writer:
+        writer.write(pd.DataFrame({'age': [40, 41]}))
+        writer.write(pd.DataFrame({'age': [0.5, None]}))
+
+    df = read_frame(path)
+    assert df['age'].tolist()[:3] == [40.0, 41.0, 0.5]
+    assert df['age'].isna().tolist() == [False, False, False, True]
+
+
+@pytest.mark.parametrize('extension', ['.parquet', '.arrow'])
+def test_types_of_the_chunks_held_back_are_widened(tmp_path, extension):
+    path = str(tmp_path / f'cases{extension}')
+    with FrameWriter(path) as writer:
+        writer.write(pd.DataFrame({'gender': [np.nan], 'age': [40]}))
+        writer.write(pd.DataFrame({'gender': ['F'], 'age': [40.5]}))
+
+    df = read_frame(path)
+    assert df['age'].tolist() == [40.0, 40.5]
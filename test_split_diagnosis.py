@@ -0,0 +1,57 @@
+import pandas as pd
+from split_diagnosis import (MAX_CASE_TEXT_LENGTH, process_cases_in_csv, separate_diagnosis, split_cases,
+                             truncate_diagnosis)
+
+
+# Every case states its own id in both parts of its text, so a row paired with the text of
+# another case is easy to spot
+def make_cases(count, long_case_ids=()):
+    rows = []
+    for case_id in range(1, count + 1):
+        case_text = f"Patient {case_id} had a fever. The final diagnosis was disease {case_id}. Follow-up was fine."
+        if case_id in long_case_ids:
+            case_text += ' padding' * MAX_CASE_TEXT_LENGTH
+        rows.append({'case_id': f"case_{case_id}", 'gender': 'F' if case_id % 2 else 'M', 'age': 20 + case_id,
+                     'case_text': case_text})
+    return pd.DataFrame(rows)
+
+
+def assert_rows_paired(df):
+    for row in df.itertuples():
+        case_number = row.case_id.split('_')[1]
+        assert row.pre_diagnosis == f"Patient {case_number} had a fever."
+        assert row.diagnosis == f"disease {case_number}."
+        assert row.age == 20 + int(case_number)
+
+
+def test_split_cases_keeps_rows_and_diagnoses_paired_around_a_long_case():
+    split_df, skipped_count = split_cases(make_cases(5, long_case_ids={3}))
+
+    assert skipped_count == 1
+    assert split_df['case_id'].tolist() == ['case_1', 'case_2', 'case_4', 'case_5']
+    assert_rows_paired(split_df)
+
+
+def test_split_cases_matches_the_per_row_functions():
+    df = make_cases(4, long_case_ids={2})
+    df.loc[4, :] = ['case_no_keyword', 'F', 30, 'No keyword in this text']
+
+    split_df, _ = split_cases(df)
+
+    for row in split_df.itertuples():
+        pre_diagnosis, diagnosis = separate_diagnosis(row.case_text)
+        assert row.pre_diagnosis == pre_diagnosis
+        assert row.diagnosis == truncate_diagnosis(diagnosis)
+
+
+def test_process_cases_in_csv_keeps_rows_paired_across_chunks(tmp_path):
+    input_file = tmp_path / 'cases_with_diagnosis.csv'
+    output_file = tmp_path / 'cases_with_separated_diagnosis_truncated.csv'
+    # Long cases at the start, the end and on both sides of the chunk boundaries
+    make_cases(9, long_case_ids={1, 3, 4, 7}).to_csv(input_file, index=False)
+
+    process_cases_in_csv(str(input_file), str(output_file), chunksize=3)
+
+    output_df = pd.read_csv(output_file)
+    assert output_df['case_id'].tolist() == ['case_2', 'case_5', 'case_6', 'case_8', 'case_9']
+    assert_rows_paired(output_df)
@@ -0,0 +1,149 @@
+import re  # For stripping non-alphabetic characters
+import os  # For the number of available cores and the local NLTK data directory
+import time  # For the tokenization and stemming timers
+import threading  # For loading the NLTK resources only once
+from concurrent.futures import ProcessPoolExecutor  # For normalizing large corpora on all cores
+from functools import lru_cache  # For memoizing stems and normalized texts
+import pandas as pd
+from metrics import metrics  # For the time spent tokenizing and stemming
+
+# Pattern removing any non-alphabetic characters, compiled once
+NON_ALPHA_PATTERN = re.compile(r'[^a-z\s]')
+
+# Directory searched for the NLTK data before NLTK_DATA and the default NLTK locations.
+# Nothing is ever downloaded, install the data once with:
+# python -m nltk.downloader -d nltk_data punkt_tab stopwords
+LOCAL_NLTK_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'nltk_data')
+
+# NLTK resources used by the normalizer and the paths they can be found under
+# (recent NLTK versions tokenize with punkt_tab, older ones with punkt)
+NLTK_RESOURCES = {
+    'punkt_tab': ['tokenizers/punkt_tab/english/', 'tokenizers/punkt/english.pickle'],
+    'stopwords': ['corpora/stopwords/english'],
+}
+
+# NLTK is slow to import, so it is loaded with its resources the first time a text is normalized
+_nltk = None
+_nltk_lock = threading.Lock()
+
+# Function to import NLTK and check that its resources are installed locally, without any network access
+def load_nltk():
+    global _nltk
+    if _nltk is not None:
+        return _nltk
+    with _nltk_lock:
+        if _nltk is None:
+            import nltk
+            if LOCAL_NLTK_DATA not in nltk.data.path:
+                nltk.data.path.insert(0, LOCAL_NLTK_DATA)
+            for name, paths in NLTK_RESOURCES.items():
+                if not any(_nltk_resource_exists(nltk, path) for path in paths):
+                    raise LookupError(f"NLTK resource '{name}' not found in {LOCAL_NLTK_DATA}, NLTK_DATA or the "
+                                      f"default NLTK directories. Install it with: "
+                                      f"python -m nltk.downloader -d {LOCAL_NLTK_DATA} {name}")
+            _nltk = nltk
+        return _nltk
+
+def _nltk_resource_exists(nltk, path):
+    try:
+        nltk.data.find(path)
+        return True
+    except LookupError:
+        return False
+
+# Function to load the english stop words the first time they are needed
+@lru_cache(maxsize=None)
+def get_stop_words():
+    load_nltk()
+    from nltk.corpus import stopwords
+    return frozenset(stopwords.words('english'))
+
+# The Porter Stemmer is stateless, so one instance is shared by all normalizers
+@lru_cache(maxsize=None)
+def get_stemmer():
+    from nltk.stem import PorterStemmer
+    return PorterStemmer()
+
+# Function to stem a single token, medical vocabularies repeat heavily so every stem is memoized
+@lru_cache(maxsize=None)
+def stem_token(token):
+    return get_stemmer().stem(token)
+
+class TextNormalizer:
+    """
+    Lowercases, strips non-alphabetic characters, tokenizes, removes stop words and
+    stems a text, returning the tuple of stemmed terms.
+
+    `preprocess` is an optional function applied to the lowercased text before it is
+    stripped (e.g. to expand abbreviations). Normalized texts are memoized, so the same
+    string is only processed once per normalizer.
+    """
+
+    def __init__(self, preprocess=None, max_cached_texts=200000):
+        self.preprocess = preprocess
+        self.max_cached_texts = max_cached_texts
+        self.terms = lru_cache(maxsize=max_cached_texts)(self._terms)
+
+    # The memoized method cannot be pickled, worker processes rebuild it from the settings
+    def __getstate__(self):
+        return {'preprocess': self.preprocess, 'max_cached_texts': self.max_cached_texts}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _terms(self, text):
+        # Convert text to lowercase for uniformity
+        text = text.lower()
+
+        if self.preprocess is not None:
+            text = self.preprocess(text)
+
+        # Remove any non-alphabetic characters
+        text = NON_ALPHA_PATTERN.sub('', text)
+
+        # Tokenize the words and remove stop words
+        start_time = time.perf_counter()
+        stop_words = get_stop_words()
+        words = [word for word in load_nltk().word_tokenize(text) if word not in stop_words]
+        tokenized_time = time.perf_counter()
+
+        # Stem relevant words
+        terms = tuple(stem_token(word) for word in words)
+        metrics.inc('tokenize_seconds', tokenized_time - start_time)
+        metrics.inc('stem_seconds', time.perf_counter() - tokenized_time)
+        metrics.inc('texts_normalized')
+        return terms
+
+    # Function to normalize a whole pandas Series, each distinct value is normalized only once.
+    # With several workers the distinct values are split into chunks that are normalized in a
+    # process pool (workers=None uses all cores); inputs below min_parallel values stay serial.
+    def normalize_series(self, series, workers=1, chunk_size=2000, min_parallel=10000):
+        unique_texts = pd.unique(series)
+        if workers is None:
+            workers = os.cpu_count() or 1
+
+        if workers <= 1 or len(unique_texts) < min_parallel:
+            unique_terms = {text: self.terms(text) for text in unique_texts}
+        else:
+            chunks = [unique_texts[i:i + chunk_size] for i in range(0, len(unique_texts), chunk_size)]
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(self,)) as executor:
+                # map() returns the chunks in their original order
+                chunk_results = executor.map(_normalize_chunk, chunks)
+                unique_terms = {}
+                for chunk, (terms, worker_counters) in zip(chunks, chunk_results):
+                    unique_terms.update(zip(chunk, terms))
+                    metrics.merge_counters(worker_counters)
+
+        return series.map(unique_terms)
+
+# Normalizer of the current worker process, set once by the pool initializer
+_worker_normalizer = None
+
+def _init_worker(normalizer):
+    global _worker_normalizer
+    _worker_normalizer = normalizer
+
+# Returns the terms of the chunk with the counters of the worker, so they add up in the parent
+def _normalize_chunk(texts):
+    metrics.reset()
+    return [_worker_normalizer.terms(text) for text in texts], dict(metrics.counters)